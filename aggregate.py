@@ -0,0 +1,201 @@
+import numpy as np
+from possession import HoldEndTypes, HOLD_END_TYPE_NAMES
+from game import score_shots
+
+# The hold end types counted for each player, in the order of their columns
+END_TYPE_COLUMNS = [HOLD_END_TYPE_NAMES[end_type] for end_type in HoldEndTypes
+                    if end_type != HoldEndTypes.NONE]
+
+# The columns of the table of player aggregates, one row per player
+# Shooting is the quality of the last shot of the possessions a player ended, and passing is the
+#     quality of the last shot of the possessions where a player made the second to last hold
+# Only shots with a quality are counted
+PLAYER_AGGREGATES_STRUCTURE = [('player id', 'int64'), ('holds', 'int64')] + \
+                              [(name, 'int64') for name in END_TYPE_COLUMNS] + \
+                              [('shooting count', 'int64'), ('shooting sum', 'float'),
+                               ('passing count', 'int64'), ('passing sum', 'float'),
+                               ('average shooting', 'float'), ('average passing', 'float'),
+                               ('shoot pass ratio', 'float'), ('number of entries', 'int64')]
+
+# Find the arrays a game contributes to the player aggregates
+# Reads a game saved as tables directly, without building its objects, and falls back to the
+#     objects for older pickled games
+# Players that aren't in the game's players are left out, like holds with no player
+def game_player_arrays(game, quality_model=None):
+    if game.tables is not None:
+        tables = game.tables
+        holds = tables['holds']
+        possessions = tables['possessions']
+        if quality_model is None:
+            qualities = tables['shots']['quality']
+        else:
+            qualities = score_shots(game, quality_model)
+        hold_players = holds['player id']
+        hold_end_types = holds['end type']
+
+        # The possessions that have a shot, with the quality of their last shot
+        # Possessions list their shots by position in the quarter, so add where each quarter starts
+        quarter_shots_start = np.zeros(max(list(tables.quarters) + [0]) + 1, dtype='int')
+        for quarter_number, ranges in tables.quarters.items():
+            quarter_shots_start[quarter_number] = ranges['shots'][0]
+        with_shots = possessions['shots stop'] > possessions['shots start']
+        last_shots = tables['possession shots'][possessions['shots stop'][with_shots] - 1] + \
+                     quarter_shots_start[possessions['quarter'][with_shots]]
+        possession_qualities = qualities[last_shots]
+        holds_start = possessions['holds start'][with_shots]
+        holds_stop = possessions['holds stop'][with_shots]
+    else:
+        hold_players = []
+        hold_end_types = []
+        possession_qualities = []
+        holds_start = []
+        holds_stop = []
+        for quarter in game.quarters.values():
+            if quarter.possessions is None:
+                continue
+            for possession in quarter.possessions:
+                thread_start = len(hold_players)
+                for hold in possession.thread:
+                    hold_players.append(-1 if hold.player_id is None else hold.player_id)
+                    hold_end_types.append(HoldEndTypes(hold.end_type_code))
+                if len(possession.shots) > 0:
+                    possession_qualities.append(possession.shots[-1].quality)
+                    holds_start.append(thread_start)
+                    holds_stop.append(len(hold_players))
+        hold_players = np.array(hold_players, dtype='int64')
+        hold_end_types = np.array(hold_end_types, dtype='int8')
+        possession_qualities = np.array(possession_qualities, dtype='float')
+        holds_start = np.array(holds_start, dtype='int')
+        holds_stop = np.array(holds_stop, dtype='int')
+
+    return _player_arrays(hold_players, hold_end_types, possession_qualities, holds_start,
+                          holds_stop, game.players)
+
+# Find the arrays of holds, shooters and passers of some possessions
+# possession_qualities, holds_start and holds_stop describe only the possessions that have a shot
+def _player_arrays(hold_players, hold_end_types, possession_qualities, holds_start, holds_stop,
+                   players):
+    known_players = np.array(sorted(players), dtype='int64')
+    lengths = holds_stop - holds_start
+    shooting = lengths >= 1
+    passing = lengths >= 2
+    shooters = hold_players[holds_stop[shooting] - 1]
+    passers = hold_players[holds_stop[passing] - 2]
+    holds_known = np.isin(hold_players, known_players)
+
+    # Shots with no quality, e.g. with no defender distance, are left out of the sums and counts
+    #     alike, rather than making the player's sums NaN
+    scored = np.isfinite(possession_qualities)
+    shooters_known = np.isin(shooters, known_players) & scored[shooting]
+    passers_known = np.isin(passers, known_players) & scored[passing]
+    return {'hold players': np.asarray(hold_players)[holds_known],
+            'hold end types': np.asarray(hold_end_types)[holds_known],
+            'shooters': shooters[shooters_known],
+            'shooting qualities': possession_qualities[shooting][shooters_known],
+            'passers': passers[passers_known],
+            'passing qualities': possession_qualities[passing][passers_known]}
+
+# Find the arrays a whole season contributes to the player aggregates, from its season index
+# The season's shots are listed in possession order, so a possession's last shot is just before
+#     its shots stop
+def season_player_arrays(index):
+    holds = index['holds']
+    possessions = index['possessions']
+    with_shots = possessions['shots stop'] > possessions['shots start']
+    possession_qualities = index['shots']['quality'][possessions['shots stop'][with_shots] - 1]
+    return _player_arrays(np.asarray(holds['player id']), np.asarray(holds['end type']),
+                          np.asarray(possession_qualities, dtype='float'),
+                          possessions['holds start'][with_shots],
+                          possessions['holds stop'][with_shots], index.players())
+
+# Add up every player's holds and shot qualities over many games
+# Every game's arrays are gathered, and each player's totals are found with grouped sums over
+#     the players' positions in the table, rather than searching for the player of every hold
+# Returns the table of aggregates, sorted by player id, and each player's row of the players file
+def aggregate_players(games, quality_model=None):
+    arrays = {}
+    players = {}
+    for game in games.values():
+        for name, array in game_player_arrays(game, quality_model).items():
+            arrays.setdefault(name, []).append(array)
+        for player_id, player in game.players.items():
+            players.setdefault(player_id, player)
+    arrays = {name: np.concatenate(parts) for name, parts in arrays.items()}
+    return _aggregate_arrays(arrays), players
+
+# Add up every player's holds and shot qualities over a whole season, from its season index
+# Reads only the index's tables, so no game has to be loaded
+# Returns the table of aggregates, sorted by player id, and each player's row of the players file
+def aggregate_season(index):
+    return _aggregate_arrays(season_player_arrays(index)), index.players()
+
+# Make the table of aggregates from the arrays of every game
+def _aggregate_arrays(arrays):
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=PLAYER_AGGREGATES_STRUCTURE)
+
+    player_ids = np.unique(np.concatenate([arrays['hold players'], arrays['shooters'],
+                                           arrays['passers']]))
+    n_players = len(player_ids)
+    table = np.zeros(n_players, dtype=PLAYER_AGGREGATES_STRUCTURE)
+    table['player id'] = player_ids
+
+    # Count each player's holds by how they ended
+    hold_rows = np.searchsorted(player_ids, arrays['hold players'])
+    table['holds'] = np.bincount(hold_rows, minlength=n_players)
+    end_type_counts = np.zeros((n_players, len(HoldEndTypes)), dtype='int64')
+    np.add.at(end_type_counts, (hold_rows, arrays['hold end types'].astype('int')), 1)
+    for end_type in HoldEndTypes:
+        if end_type != HoldEndTypes.NONE:
+            table[HOLD_END_TYPE_NAMES[end_type]] = end_type_counts[:, end_type]
+
+    # Add up the shot qualities of each player's shooting and passing
+    shooter_rows = np.searchsorted(player_ids, arrays['shooters'])
+    passer_rows = np.searchsorted(player_ids, arrays['passers'])
+    table['shooting count'] = np.bincount(shooter_rows, minlength=n_players)
+    table['shooting sum'] = np.bincount(shooter_rows, weights=arrays['shooting qualities'],
+                                        minlength=n_players)
+    table['passing count'] = np.bincount(passer_rows, minlength=n_players)
+    table['passing sum'] = np.bincount(passer_rows, weights=arrays['passing qualities'],
+                                       minlength=n_players)
+
+    # Derive the averages and ratios, leaving NaN where they are undefined
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['average shooting'] = table['shooting sum'] / table['shooting count']
+        table['average passing'] = table['passing sum'] / table['passing count']
+        table['shoot pass ratio'] = np.where(
+            (table['shooting count'] > 0) & (table['passing count'] > 0),
+            np.log10(table['shooting count'] / table['passing count']), np.nan)
+    table['number of entries'] = table['shooting count'] + table['passing count']
+    return table
+
+# Read a number from the players file, or NaN if it's missing
+def _player_number(player, key):
+    try:
+        return float(player[key])
+    except (KeyError, TypeError, ValueError):
+        return float('nan')
+
+# Make the (player, counts, coordinates) list visualize.triangle_scatter_players plots
+# Only players with more than min_actions passes, shots and dribbles are included
+def triangle_coords(table, players, min_actions=15):
+    players_coords = []
+    for row in table:
+        counts = {'pass': int(row['pass']), 'shot': int(row['shot']), 'dribble': int(row['dribble'])}
+        total = sum(counts.values())
+        if total > min_actions:
+            stats = {action: count*1.0/total for action, count in counts.items()}
+            players_coords.append((players[int(row['player id'])], counts,
+                                   [stats['pass'] + 0.500*stats['shot'], 0.866*stats['shot']]))
+    return players_coords
+
+# Make the (player, record) list visualize.plot_pass_shoot plots
+def pass_shoot_records(table, players):
+    players_records = []
+    for row in table:
+        player = players[int(row['player id'])]
+        player_record = {name: row[name].item() for name, _ in PLAYER_AGGREGATES_STRUCTURE}
+        player_record['efg'] = _player_number(player, 'efg')
+        player_record['efg plus'] = 100*player_record['efg'] - player_record['average shooting']
+        players_records.append((player, player_record))
+    return players_records
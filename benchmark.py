@@ -0,0 +1,239 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import clusterpoints
+import download_and_process
+import processing
+from game import load_processed_data
+from possession import Possession, PlayTypes, make_threads
+from synthetic import write_synthetic_games
+
+# The stored results that new results are compared against
+BASELINE_FILENAME = 'benchmark baseline.json'
+
+# The number of synthetic games at each scale
+SCALES = {'small': 2, 'medium': 8, 'large': 32}
+
+# The number of lineups clustered for every game at a scale
+LINEUPS_PER_GAME = 30
+
+# How much slower than the baseline a benchmark can be before it counts as a regression
+REGRESSION_RATIO = 1.25
+
+# The shortest time a measurement may take, so short benchmarks are run many times in a row
+#     and timer noise doesn't decide whether they regressed
+MIN_MEASUREMENT_SECONDS = 0.2
+
+# Time a function, calling it as many times in a row as it takes to fill min_seconds, like
+#     timeit's autorange
+# Returns the average time of one call
+def time_calls(func, min_seconds=MIN_MEASUREMENT_SECONDS):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed/number
+        number *= 2
+
+# Time a function several times, and find its fastest time and the most memory it allocated
+# Memory is found in a separate run with tracemalloc, so tracing doesn't slow the timed runs
+# Anything the function prints is hidden
+def measure(func, repeat=3):
+    with contextlib.redirect_stdout(io.StringIO()):
+        times = [time_calls(func) for _ in range(repeat)]
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return min(times), peak/2**20
+
+# Make the synthetic games of a scale, and process them once
+# Returns everything the benchmarks need, read outside the timed code
+def prepare_scale(work_dir, number_of_games, seed=0):
+    secondspectrum_dir = os.path.join(work_dir, 'secondspectrum')
+    result_dir = os.path.join(work_dir, 'processed_data')
+    game_codes = write_synthetic_games(secondspectrum_dir, number_of_games, seed=seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        download_and_process.process_secondspectrum_games(secondspectrum_dir, result_dir)
+        games = load_processed_data(result_dir, cache_size=0)
+
+        # The documents and events of every quarter, to read the shots from
+        quarters = []
+        for game_code in game_codes:
+            documents = processing.GameDocuments(secondspectrum_dir, game_code)
+            players_data = processing.read_player_data(documents)
+            teams_data = processing.read_teams_data(documents)
+            for quarter in range(1, 5):
+                events_data = processing.read_pbp_data(documents, quarter, teams_data,
+                                                       players_data)
+                quarters.append((documents, quarter, players_data, events_data))
+
+    # The events of every possession, to make threads from
+    possessions = []
+    for game in games.values():
+        for quarter in game.quarters.values():
+            if quarter.possessions is not None:
+                possessions.append((np.array(quarter.events),
+                                    [np.asarray(possession.event_indices)
+                                     for possession in quarter.possessions]))
+
+    # Lineups of five players, each with a point for their passing and shooting, like the ones
+    #     clustered in the notebooks
+    rnd = np.random.default_rng(seed)
+    lineups = [{'team name': str(i), 'players': list(rnd.normal(size=(5, 2)))}
+               for i in range(LINEUPS_PER_GAME*number_of_games)]
+
+    return {'secondspectrum dir': secondspectrum_dir, 'result dir': result_dir,
+            'games': number_of_games, 'quarters': quarters, 'possessions': possessions,
+            'lineups': lineups}
+
+# The benchmarks, each a function of the prepared data that returns the function to time and
+#     the number of items it handles
+def benchmark_process(data):
+    def run():
+        download_and_process.process_secondspectrum_games(
+            data['secondspectrum dir'], data['result dir'], force=True)
+    return run, data['games'], 'games'
+
+def benchmark_load(data):
+    def run():
+        games = load_processed_data(data['result dir'], cache_size=0)
+        for game in games.values():
+            for quarter in game.quarters.values():
+                len(quarter.possessions or [])
+    return run, data['games'], 'games'
+
+def benchmark_make_thread(data):
+    def run():
+        for events, event_indices in data['possessions']:
+            for indices in event_indices:
+                Possession(None, None, None).make_thread(events[indices], {})
+    return run, sum(len(indices) for _, indices in data['possessions']), 'possessions'
+
+def benchmark_make_threads(data):
+    def run():
+        for events, event_indices in data['possessions']:
+            make_threads(events, event_indices)
+    return run, sum(len(indices) for _, indices in data['possessions']), 'possessions'
+
+def benchmark_read_shots(data):
+    def run():
+        for documents, quarter, players_data, events_data in data['quarters']:
+            processing.read_shots(documents, quarter, players_data, events_data)
+    shot_types = [PlayTypes.FIELD_GOAL_MADE, PlayTypes.FIELD_GOAL_MISSED]
+    number_of_shots = sum(int(np.isin(events_data['event type'], shot_types).sum())
+                          for _, _, _, events_data in data['quarters'])
+    return run, number_of_shots, 'shots'
+
+def benchmark_cluster_points(data):
+    def run():
+        clusterpoints.cluster_points(data['lineups'], 4, lambda lineup: lineup['players'],
+                                     seed=0)
+    return run, len(data['lineups']), 'lineups'
+
+BENCHMARKS = {'process_secondspectrum_games': benchmark_process,
+              'load_processed_data': benchmark_load,
+              'Possession.make_thread': benchmark_make_thread,
+              'make_threads': benchmark_make_threads,
+              'read_shots': benchmark_read_shots,
+              'cluster_points': benchmark_cluster_points}
+
+# Run every benchmark at some scales
+# Returns the results as {benchmark: {scale: result}}
+def run_benchmarks(scales, repeat=3, benchmarks=None):
+    benchmarks = benchmarks or list(BENCHMARKS)
+    results = {name: {} for name in benchmarks}
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as work_dir:
+            data = prepare_scale(work_dir, SCALES[scale])
+            for name in benchmarks:
+                run, number_of_items, unit = BENCHMARKS[name](data)
+                seconds, peak_memory = measure(run, repeat)
+                results[name][scale] = {'seconds': seconds,
+                                        'items': number_of_items,
+                                        'unit': unit,
+                                        'per second': number_of_items/seconds if seconds > 0
+                                                      else float('nan'),
+                                        'peak memory': peak_memory}
+                print("{:<30} {:<8} {:>10.4f}s {:>12.1f} {}/s {:>8.1f}MB".format(
+                    name, scale, seconds, results[name][scale]['per second'], unit, peak_memory))
+    return results
+
+# Describe the machine and libraries the benchmarks ran on
+def describe_environment():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processors': os.cpu_count()}
+
+# Compare results with a baseline
+# Returns a line describing every benchmark in both, and the names of those slower than the
+#     baseline by more than ratio
+def compare_to_baseline(results, baseline, ratio=REGRESSION_RATIO):
+    lines = []
+    regressions = []
+    for name, scales in results.items():
+        for scale, result in scales.items():
+            try:
+                baseline_result = baseline['results'][name][scale]
+            except KeyError:
+                continue
+            change = result['seconds']/baseline_result['seconds']
+            regressed = change > ratio
+            if regressed:
+                regressions.append('{} {}'.format(name, scale))
+            lines.append("{:<30} {:<8} {:>6.2f}x the baseline time{}".format(
+                name, scale, change, ' (regression)' if regressed else ''))
+    return lines, regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark processing and clustering on synthetic secondspectrum games')
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small', 'medium'])
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_FILENAME)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--ratio', type=float, default=REGRESSION_RATIO,
+                        help='how many times slower than the baseline counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scales, args.repeat, args.benchmarks)
+    if args.save_baseline:
+        with open(args.baseline, 'wt') as file:
+            json.dump({'environment': describe_environment(), 'results': results}, file,
+                      indent=1, sort_keys=True)
+        print("Saved the baseline to {}".format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with at {}".format(args.baseline))
+        return 0
+    with open(args.baseline, 'rt') as file:
+        baseline = json.load(file)
+    if baseline.get('environment') != describe_environment():
+        print("The baseline was measured on {}, so times may not be comparable".format(
+            baseline.get('environment')))
+    lines, regressions = compare_to_baseline(results, baseline, args.ratio)
+    for line in lines:
+        print(line)
+    if regressions:
+        print("{} regressions: {}".format(len(regressions), ', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
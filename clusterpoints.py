@@ -1,9 +1,14 @@
-import random
+import hashlib
 import itertools
+import os
+import concurrent.futures
 import numpy as np
+import scipy.optimize
 
 # Find the minimum distance between corresponding points in two sets
-# Use brute force to just try every possible arrangement
+# Solve the assignment exactly with the Hungarian algorithm, rather than trying every arrangement
+# Returns, for each point in b, the index of the point in a it corresponds to, and the total
+#     squared distance between corresponding points
 def find_correspondence_distance(a, b):
     # We want to assume that a is the longer list
     # If it isn't, swap them, and then do some work to invert the returned indices
@@ -13,22 +18,18 @@ def find_correspondence_distance(a, b):
         for i in range(len(opposite)):
             result[opposite[i]] = i
         return tuple(result), score
+    if len(b) == 0:
+        return (), 0
     
     # Compute the distance between every pair of points
-    dists = [[0 for i in range(len(b))] for i in range(len(a))]
-    for ia in range(len(a)):
-        for ib in range(len(b)):
-            dists[ia][ib] = (sum((a[ia][j] - b[ib][j])**2 for j in range(len(a[0]))))
-    
-    # Try every possible permutation of assignments, noting the best one
-    assignment_indices = range(len(a))
-    best_assignment = None
-    best_assignment_score = float('inf')
-    for assignment in itertools.permutations(assignment_indices, len(b)):
-        assignment_score = sum(dists[assignment[i]][i] for i in range(len(assignment)))
-        if assignment_score < best_assignment_score:
-            best_assignment_score = assignment_score
-            best_assignment = assignment
+    a_points = np.asarray(a, dtype='float')
+    b_points = np.asarray(b, dtype='float')
+    dists = ((b_points[:, np.newaxis, :] - a_points[np.newaxis, :, :])**2).sum(axis=2)
+    
+    # Find the cheapest assignment of a point in a to every point in b
+    b_indices, a_indices = scipy.optimize.linear_sum_assignment(dists)
+    best_assignment = tuple(int(i) for i in a_indices)
+    best_assignment_score = float(dists[b_indices, a_indices].sum())
     
     return best_assignment, best_assignment_score
 
@@ -68,55 +69,612 @@ def mean_correspondence_distance(lists):
     mean = [(sums[i][0]/counts[i],sums[i][1]/counts[i]) for i in range(len(sums))]
     return mean
 
-# Implements k-means to iteratively find useful clusters of the data
-def cluster_points(lists, n_groups, points_func=lambda x:x, iterations_after_none=10):
-    # Randomly assign the inputs to different groups
-    random.shuffle(lists)
-    num_per_group = int(len(lists)/n_groups)
-    groups = [{'mean': None,
-               'nearest': lists[i*num_per_group:(i+1)*num_per_group],
-               'score sum': 0
-              } for i in range(n_groups)]
-    
-    # Keep running until some number of iterations have passed without an empty list
+# Pack lists of points of different lengths into one padded array
+# Returns an array of shape (number of lists, longest list, dimensions) and a mask of the real points
+def pack_points(lists, dims=None):
+    max_len = max([len(points) for points in lists] + [0])
+    if dims is None:
+        dims = next((len(points[0]) for points in lists if len(points) > 0), 2)
+    packed = np.zeros((len(lists), max_len, dims))
+    mask = np.zeros((len(lists), max_len), dtype='bool')
+    for i, points in enumerate(lists):
+        if len(points) > 0:
+            packed[i, :len(points)] = points
+            mask[i, :len(points)] = True
+    return packed, mask
+
+# Any assignment that uses a forbidden pairing costs more than every real assignment
+FORBIDDEN_COST = 1e18
+
+# Solve every list-to-mean correspondence at once
+# points/points_mask and means/means_mask are packed as by pack_points
+# Returns scores of shape (lists, means), and assignments of shape (lists, means, points per list)
+#     giving the index of the mean point each point corresponds to, or -1 if it has none
+# Small sets are solved by checking every arrangement for every pair at once, larger ones
+#     with the Hungarian algorithm one pair at a time
+# Pairs are solved in chunks of lists and means, so no intermediate array has more than about
+#     max_chunk_elements values however many lists and means there are
+def batch_correspondence_distance(points, points_mask, means, means_mask, max_brute_force=6,
+                                  max_chunk_elements=2**22):
+    n_lists, n_points, _ = points.shape
+    n_means, n_mean_points, _ = means.shape
+    size = max(n_points, n_mean_points)
+    scores = np.zeros((n_lists, n_means))
+    assignments = np.full((n_lists, n_means, n_points), -1)
+    if size == 0 or n_lists == 0 or n_means == 0:
+        return scores, assignments
+    
+    # Pad both sides to square cost matrices of the same size
+    points_padded = np.zeros((n_lists, size, points.shape[2]))
+    points_padded[:, :n_points] = points
+    real_points = np.zeros((n_lists, size), dtype='bool')
+    real_points[:, :n_points] = points_mask
+    means_padded = np.zeros((n_means, size, means.shape[2]))
+    means_padded[:, :n_mean_points] = means
+    real_means = np.zeros((n_means, size), dtype='bool')
+    real_means[:, :n_mean_points] = means_mask
+    list_lengths = real_points.sum(axis=1)
+    mean_lengths = real_means.sum(axis=1)
+    
+    # Every pair needs its cost matrix, and every arrangement when they are all checked
+    pair_elements = size*size*points.shape[2]
+    if size <= max_brute_force:
+        permutations = np.array(list(itertools.permutations(range(size))))
+        pair_elements = max(pair_elements, len(permutations)*size)
+    means_per_chunk = max(1, min(n_means, max_chunk_elements // pair_elements))
+    lists_per_chunk = max(1, max_chunk_elements // (pair_elements*means_per_chunk))
+    
+    for start in range(0, n_lists, lists_per_chunk):
+        stop = min(start + lists_per_chunk, n_lists)
+        for mean_start in range(0, n_means, means_per_chunk):
+            mean_stop = min(mean_start + means_per_chunk, n_means)
+            
+            # Compute the cost of pairing every point with every mean point
+            # Padding may only be paired up so that min(list length, mean length) real pairs
+            #     are made
+            chunk_means = slice(mean_start, mean_stop)
+            costs = ((points_padded[start:stop, np.newaxis, :, np.newaxis, :] -
+                      means_padded[np.newaxis, chunk_means, np.newaxis, :, :])**2).sum(axis=4)
+            point_is_real = real_points[start:stop, np.newaxis, :, np.newaxis]
+            mean_is_real = real_means[np.newaxis, chunk_means, np.newaxis, :]
+            longer_list = (list_lengths[start:stop, np.newaxis] >
+                           mean_lengths[np.newaxis, chunk_means])[:, :, np.newaxis, np.newaxis]
+            shorter_list = (list_lengths[start:stop, np.newaxis] <
+                            mean_lengths[np.newaxis, chunk_means])[:, :, np.newaxis, np.newaxis]
+            costs = np.where(point_is_real & mean_is_real, costs, 0.0)
+            costs = np.where(point_is_real & ~mean_is_real & ~longer_list, FORBIDDEN_COST, costs)
+            costs = np.where(~point_is_real & mean_is_real & ~shorter_list, FORBIDDEN_COST, costs)
+            
+            if size <= max_brute_force:
+                # Score every arrangement of every pair at once, and keep the cheapest
+                arrangement_costs = costs[:, :, np.arange(size), permutations].sum(axis=3)
+                best = np.argmin(arrangement_costs, axis=2)
+                chunk_scores = np.take_along_axis(arrangement_costs, best[:, :, np.newaxis],
+                                                  axis=2)[:, :, 0]
+                chunk_assignments = permutations[best]
+            else:
+                chunk_scores = np.zeros(costs.shape[:2])
+                chunk_assignments = np.zeros(costs.shape[:3], dtype='int')
+                for i in range(costs.shape[0]):
+                    for k in range(costs.shape[1]):
+                        rows, cols = scipy.optimize.linear_sum_assignment(costs[i, k])
+                        chunk_scores[i, k] = costs[i, k][rows, cols].sum()
+                        chunk_assignments[i, k, rows] = cols
+            
+            # Points paired with padding have no corresponding mean point
+            chunk_assignments = chunk_assignments[:, :, :n_points]
+            paired_real = np.take_along_axis(
+                np.broadcast_to(real_means[np.newaxis, chunk_means],
+                                (stop - start, mean_stop - mean_start, size)),
+                chunk_assignments, axis=2)
+            chunk_assignments = np.where(paired_real & points_mask[start:stop, np.newaxis, :],
+                                         chunk_assignments, -1)
+            scores[start:stop, chunk_means] = chunk_scores
+            assignments[start:stop, chunk_means] = chunk_assignments
+    return scores, assignments
+
+# Compute the mean of some packed lists, as in mean_correspondence_distance
+# The longest list is used as the master ordering, and every list is aligned to it
+# Returns the mean points, or None if there are no lists
+def batch_mean_correspondence_distance(points, points_mask):
+    if len(points) == 0:
+        return None
+    lengths = points_mask.sum(axis=1)
+    master = int(np.argmax(lengths))
+    master_length = int(lengths[master])
+    _, assignments = batch_correspondence_distance(
+        points, points_mask, points[master:master + 1, :master_length],
+        points_mask[master:master + 1, :master_length])
+    assignments = assignments[:, 0, :]
+    
+    # Add up the points assigned to each master point, then divide by how many there were
+    assigned = assignments >= 0
+    sums = np.zeros((master_length, points.shape[2]))
+    counts = np.zeros(master_length)
+    np.add.at(sums, assignments[assigned], points[assigned])
+    np.add.at(counts, assignments[assigned], 1)
+    return sums / counts[:, np.newaxis]
+
+# Choose starting groups with k-means++: each new seed is a random input, picked with probability
+#     proportional to its squared correspondence distance from the nearest seed so far
+# Returns the group of every input
+def choose_seed_groups(points, points_mask, n_groups, rng):
+    n_lists = len(points)
+    seeds = [int(rng.integers(n_lists))]
+    scores, _ = batch_correspondence_distance(points, points_mask,
+                                              points[seeds[-1:]], points_mask[seeds[-1:]])
+    nearest = scores[:, 0]
+    all_scores = [scores[:, 0]]
+    for i in range(1, n_groups):
+        total = nearest.sum()
+        probabilities = nearest / total if total > 0 else np.full(n_lists, 1.0 / n_lists)
+        seeds.append(int(rng.choice(n_lists, p=probabilities)))
+        scores, _ = batch_correspondence_distance(points, points_mask,
+                                                  points[seeds[-1:]], points_mask[seeds[-1:]])
+        nearest = np.minimum(nearest, scores[:, 0])
+        all_scores.append(scores[:, 0])
+    return np.argmin(np.stack(all_scores, axis=1), axis=1)
+
+# Run k-means once on packed points
+# Starts from k-means++ seeds, or from a random even split of the inputs with init='random'
+# Stops when the assignments and the total score stop changing, or after iterations_after_none
+#     iterations without an empty group, or after max_iterations iterations
+def _fit_packed_points(points, points_mask, n_groups, seed, init='k-means++',
+                       iterations_after_none=10, max_iterations=1000, tolerance=1e-9):
+    rng = np.random.default_rng(seed)
+    n_lists = len(points)
+    if init == 'k-means++':
+        labels = choose_seed_groups(points, points_mask, n_groups, rng)
+        members = [np.flatnonzero(labels == i) for i in range(n_groups)]
+    else:
+        order = rng.permutation(n_lists)
+        num_per_group = int(n_lists/n_groups)
+        members = [order[i*num_per_group:(i+1)*num_per_group] for i in range(n_groups)]
+    
     count_since_none = 0
-    while count_since_none < iterations_after_none:
-        # Compute a new mean for the group
-        for group in groups:
-            group['mean'] = mean_correspondence_distance([points_func(obj)
-                                                          for obj in group['nearest']])
-            # If the list was empty, then just assign three inputs and compute a mean
-            if group['mean'] is None:
-                group['mean'] = mean_correspondence_distance([points_func(obj)
-                                                              for obj in [random.choice(lists) for i in range(3)]])
+    iterations = 0
+    previous_labels = None
+    previous_inertia = None
+    while count_since_none < iterations_after_none and iterations < max_iterations:
+        # Compute a new mean for each group
+        # If a group is empty, then just assign three inputs and compute a mean
+        means = []
+        reseeded = False
+        for group_members in members:
+            mean = batch_mean_correspondence_distance(points[group_members],
+                                                      points_mask[group_members])
+            if mean is None:
+                chosen = rng.integers(n_lists, size=3)
+                mean = batch_mean_correspondence_distance(points[chosen], points_mask[chosen])
                 count_since_none = 0
-
-        # Reset the inputs assigned to each group
-        for group in groups:
-            group['nearest'] = []
-            group['score sum'] = 0
-            group['clusters'] = [[] for x in group['mean']]
+                reseeded = True
+            means.append(mean)
+        packed_means, means_mask = pack_points(means, points.shape[2])
         
-        # Assign each input to the group it is closest to
-        for obj in lists:
-            points = points_func(obj)
-            best_group = None
-            best_assignment = None
-            best_score = float('inf')
-            # Try every group, and just record the best group
-            for group in groups:
-                assignment, score = find_correspondence_distance(group['mean'], points)
-                if score < best_score:
-                    best_score = score
-                    best_group = group
-                    best_assignment = assignment
-            best_group['score sum'] += best_score
-            best_group['nearest'].append(obj)
-            for i in range(len(best_assignment)):
-                best_group['clusters'][best_assignment[i]].append((points_func(obj)[i], obj['players'][i]))
+        # Assign each input to the group it is closest to, the first group winning ties
+        scores, assignments = batch_correspondence_distance(points, points_mask,
+                                                            packed_means, means_mask)
+        labels = np.argmin(scores, axis=1)
+        inertia = scores[np.arange(n_lists), labels].sum()
+        members = [np.flatnonzero(labels == i) for i in range(n_groups)]
+        iterations += 1
         count_since_none += 1
+        
+        # Once the assignments repeat, every later iteration would be the same
+        if not reseeded and previous_labels is not None and \
+           np.array_equal(labels, previous_labels) and \
+           abs(previous_inertia - inertia) <= tolerance * max(1.0, abs(inertia)):
+            break
+        previous_labels = labels
+        previous_inertia = inertia
+    
+    return {'labels': labels, 'means': means, 'scores': scores, 'assignments': assignments,
+            'inertia': inertia, 'iterations': iterations}
+
+# Run k-means n_init times from seeds spawned from seed, and keep the run with the lowest total score
+def _fit_best_packed_points(points, points_mask, n_groups, seed, n_init=1, **fit_kwargs):
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    runs = [_fit_packed_points(points, points_mask, n_groups, run_seed, **fit_kwargs)
+            for run_seed in seed.spawn(n_init)]
+    return min(runs, key=lambda run: run['inertia'])
+
+# Describe each group of a k-means run in terms of the original inputs
+def describe_groups(lists, points_lists, run):
+    groups = [{'mean': [tuple(point) for point in mean],
+               'nearest': [],
+               'score sum': 0,
+               'clusters': [[] for x in mean]
+              } for mean in run['means']]
+    for j, obj in enumerate(lists):
+        label = run['labels'][j]
+        best_group = groups[label]
+        best_group['score sum'] += run['scores'][j, label]
+        best_group['nearest'].append(obj)
+        best_assignment = run['assignments'][j, label]
+        for i in range(len(points_lists[j])):
+            if best_assignment[i] >= 0:
+                best_group['clusters'][best_assignment[i]].append((points_lists[j][i],
+                                                                   obj['players'][i]))
     
     # Compute the average score of the groups
     for group in groups:
-        group['score average'] = group['score sum']*1.0/len(group['nearest'])
-    return groups
\ No newline at end of file
+        if len(group['nearest']) > 0:
+            group['score average'] = group['score sum']*1.0/len(group['nearest'])
+        else:
+            group['score average'] = float('nan')
+        group['iterations'] = run['iterations']
+    return groups
+
+# The largest sets whose pairwise distances are found by checking every arrangement
+PAIRWISE_MAX_BRUTE_FORCE = 4
+
+# The packed points shared with worker processes
+_shared_points = None
+def _share_points(points, points_mask):
+    global _shared_points
+    _shared_points = (points, points_mask)
+
+# Compute one block of the distance matrix, from the points shared with this worker
+def _shared_distance_block(start, stop, column_start, column_stop):
+    points, points_mask = _shared_points
+    return _distance_block(points, points_mask, start, stop, column_start, column_stop)
+
+# Compute the distances between the inputs of one range of rows and those of a range of columns
+# Every arrangement is only checked for small sets, since here each block solves a great many
+#     pairs and checking every arrangement of six points costs far more than solving them
+def _distance_block(points, points_mask, start, stop, column_start, column_stop):
+    scores, _ = batch_correspondence_distance(points[start:stop], points_mask[start:stop],
+                                              points[column_start:column_stop],
+                                              points_mask[column_start:column_stop],
+                                              max_brute_force=PAIRWISE_MAX_BRUTE_FORCE)
+    return scores
+
+# Compute the correspondence distance between every pair of inputs
+# Only the blocks on and above the diagonal are computed, in parallel when workers > 1, and
+#     mirrored so the matrix is exactly symmetric
+def pairwise_correspondence_distance(points, points_mask, workers=1, rows_per_task=64):
+    n_lists = len(points)
+    distances = np.zeros((n_lists, n_lists))
+    blocks = [(start, min(start + rows_per_task, n_lists),
+               column_start, min(column_start + rows_per_task, n_lists))
+              for start in range(0, n_lists, rows_per_task)
+              for column_start in range(start, n_lists, rows_per_task)]
+    if workers > 1 and len(blocks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_share_points,
+                                                    initargs=(points, points_mask)) as executor:
+            futures = {executor.submit(_shared_distance_block, *block): block for block in blocks}
+            for future in concurrent.futures.as_completed(futures):
+                start, stop, column_start, column_stop = futures[future]
+                distances[start:stop, column_start:column_stop] = future.result()
+    else:
+        for start, stop, column_start, column_stop in blocks:
+            distances[start:stop, column_start:column_stop] = _distance_block(
+                points, points_mask, start, stop, column_start, column_stop)
+    return np.triu(distances) + np.triu(distances, 1).T
+
+# Hash packed points, to name their saved distance matrix
+def hash_points(points, points_mask):
+    digest = hashlib.sha1()
+    digest.update(repr((points.shape, str(points.dtype))).encode())
+    digest.update(np.ascontiguousarray(points).tobytes())
+    digest.update(np.ascontiguousarray(points_mask).tobytes())
+    return digest.hexdigest()
+
+# Get the distance matrix of some packed points, computing it only if it hasn't been saved before
+# Matrices are saved in cache_dir as <hash of the points>.npy, and loaded memory-mapped
+# With no cache_dir, the matrix is just computed
+def load_distance_matrix(points, points_mask, cache_dir=None, workers=1):
+    if cache_dir is None:
+        return pairwise_correspondence_distance(points, points_mask, workers)
+    filename = os.path.join(cache_dir, hash_points(points, points_mask) + '.npy')
+    if not os.path.exists(filename):
+        distances = pairwise_correspondence_distance(points, points_mask, workers)
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        # Write to a temporary file first, so a half-written matrix is never loaded
+        with open(filename + '.tmp', 'wb') as file:
+            np.save(file, distances)
+        os.replace(filename + '.tmp', filename)
+    return np.load(filename, mmap_mode='r')
+
+# Run k-medoids once on a distance matrix
+# Like k-means, but each group is centred on one of its inputs, the one with the lowest total
+#     distance to the rest of the group, so no correspondences have to be solved
+# Starts from k-means++ seeds chosen with the same distances
+def _fit_medoids(distances, n_groups, seed, max_iterations=1000):
+    rng = np.random.default_rng(seed)
+    n_lists = len(distances)
+    medoids = [int(rng.integers(n_lists))]
+    nearest = np.array(distances[:, medoids[0]])
+    for i in range(1, n_groups):
+        total = nearest.sum()
+        probabilities = nearest / total if total > 0 else np.full(n_lists, 1.0 / n_lists)
+        medoids.append(int(rng.choice(n_lists, p=probabilities)))
+        nearest = np.minimum(nearest, distances[:, medoids[-1]])
+    
+    iterations = 0
+    while iterations < max_iterations:
+        # Assign each input to its nearest medoid, the first group winning ties
+        scores = np.array(distances[:, medoids])
+        labels = np.argmin(scores, axis=1)
+        iterations += 1
+        
+        # Move each medoid to the member closest to the rest of its group
+        new_medoids = []
+        for i in range(n_groups):
+            members = np.flatnonzero(labels == i)
+            if len(members) == 0:
+                new_medoids.append(medoids[i])
+                continue
+            costs = np.asarray(distances[np.ix_(members, members)]).sum(axis=1)
+            new_medoids.append(int(members[np.argmin(costs)]))
+        if new_medoids == medoids:
+            break
+        medoids = new_medoids
+    
+    return {'labels': labels, 'medoids': medoids, 'scores': scores,
+            'inertia': scores[np.arange(n_lists), labels].sum(), 'iterations': iterations}
+
+# Run k-medoids n_init times from seeds spawned from seed, and turn the best run into the form
+#     describe_groups expects
+# The only correspondences solved are between the inputs and the final medoids
+def _fit_best_medoids(points, points_mask, distances, n_groups, seed, n_init=1, max_iterations=1000):
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    runs = [_fit_medoids(distances, n_groups, run_seed, max_iterations)
+            for run_seed in seed.spawn(n_init)]
+    run = min(runs, key=lambda run: run['inertia'])
+    medoids = run['medoids']
+    _, assignments = batch_correspondence_distance(points, points_mask,
+                                                   points[medoids], points_mask[medoids])
+    run['means'] = [points[i][points_mask[i]] for i in medoids]
+    run['assignments'] = assignments
+    return run
+
+# Implements k-means to iteratively find useful clusters of the data
+# Every input's points are found once, and each iteration assigns all inputs to all groups at once
+# Runs n_init times from different seeds, in parallel when workers > 1, and keeps the run with
+#     the lowest total score
+# Pass seed to get the same result every time; the input list is not changed
+# With method='k-medoids', groups are centred on inputs instead, using a distance matrix that is
+#     computed once and saved in cache_dir, so repeated runs on the same data solve almost nothing
+def cluster_points(lists, n_groups, points_func=lambda x:x, iterations_after_none=10,
+                   max_iterations=1000, n_init=1, seed=None, workers=1, init='k-means++',
+                   tolerance=1e-9, method='k-means', cache_dir=None):
+    points_lists = [points_func(obj) for obj in lists]
+    points, points_mask = pack_points(points_lists)
+    
+    if method == 'k-medoids':
+        distances = load_distance_matrix(points, points_mask, cache_dir, workers)
+        best_run = _fit_best_medoids(points, points_mask, distances, n_groups, seed, n_init,
+                                     max_iterations)
+        return describe_groups(lists, points_lists, best_run)
+    elif method != 'k-means':
+        raise ValueError('Unknown clustering method {}'.format(method))
+    
+    # Every run gets its own seed, so the result doesn't depend on the number of workers
+    fit_kwargs = {'init': init, 'iterations_after_none': iterations_after_none,
+                  'max_iterations': max_iterations, 'tolerance': tolerance}
+    if workers > 1 and n_init > 1:
+        seeds = np.random.SeedSequence(seed).spawn(n_init)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_fit_packed_points, points, points_mask, n_groups,
+                                       run_seed, **fit_kwargs)
+                       for run_seed in seeds]
+            runs = [future.result() for future in futures]
+        best_run = min(runs, key=lambda run: run['inertia'])
+    else:
+        best_run = _fit_best_packed_points(points, points_mask, n_groups, seed, n_init, **fit_kwargs)
+    
+    return describe_groups(lists, points_lists, best_run)
+
+# Compute the silhouette of every input from a matrix of distances between inputs
+# Compares the mean distance to the rest of its own group with the mean distance to the
+#     closest other group; inputs alone in their group score 0
+def silhouette_scores(distances, labels):
+    n_groups = labels.max() + 1 if len(labels) > 0 else 0
+    result = np.zeros(len(labels))
+    if n_groups < 2:
+        return np.full(len(labels), np.nan)
+    sizes = np.bincount(labels, minlength=n_groups)
+    group_sums = np.zeros((len(labels), n_groups))
+    for i in range(n_groups):
+        group_sums[:, i] = distances[:, labels == i].sum(axis=1)
+    own = labels
+    own_size = sizes[own]
+    a = np.where(own_size > 1, group_sums[np.arange(len(labels)), own] / np.maximum(own_size - 1, 1), 0)
+    other_means = np.where(sizes[np.newaxis, :] > 0, group_sums / np.maximum(sizes, 1)[np.newaxis, :],
+                           np.inf)
+    other_means[np.arange(len(labels)), own] = np.inf
+    b = other_means.min(axis=1)
+    valid = (own_size > 1) & np.isfinite(b)
+    result[valid] = (b[valid] - a[valid]) / np.maximum(np.maximum(a[valid], b[valid]), 1e-300)
+    return result
+
+# Run k-means for one number of groups, on the points shared with this worker
+def _fit_shared_points(n_groups, seed, n_init, fit_kwargs):
+    points, points_mask = _shared_points
+    return _fit_best_packed_points(points, points_mask, n_groups, seed, n_init, **fit_kwargs)
+
+# Run k-means for a range of numbers of groups, to choose how many groups to use
+# The inputs' points and the distances between them are found once and shared by every run;
+#     with workers > 1 the values of k run in parallel, each worker receiving the points once
+# Returns, for every k, the groups, the total and average scores, and the silhouette scores
+def sweep(lists, ks=range(1, 10), points_func=lambda x:x, workers=1, n_init=1, seed=None,
+          iterations_after_none=10, max_iterations=1000, init='k-means++', tolerance=1e-9,
+          cache_dir=None):
+    points_lists = [points_func(obj) for obj in lists]
+    points, points_mask = pack_points(points_lists)
+    distances = load_distance_matrix(points, points_mask, cache_dir, workers)
+    
+    ks = list(ks)
+    seeds = np.random.SeedSequence(seed).spawn(len(ks))
+    fit_kwargs = {'init': init, 'iterations_after_none': iterations_after_none,
+                  'max_iterations': max_iterations, 'tolerance': tolerance}
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_share_points,
+                                                    initargs=(points, points_mask)) as executor:
+            futures = [executor.submit(_fit_shared_points, k, k_seed, n_init, fit_kwargs)
+                       for k, k_seed in zip(ks, seeds)]
+            runs = [future.result() for future in futures]
+    else:
+        runs = [_fit_best_packed_points(points, points_mask, k, k_seed, n_init, **fit_kwargs)
+                for k, k_seed in zip(ks, seeds)]
+    
+    results = []
+    for k, run in zip(ks, runs):
+        groups = describe_groups(lists, points_lists, run)
+        silhouettes = silhouette_scores(distances, run['labels'])
+        results.append({'k': k,
+                        'groups': groups,
+                        'inertia': run['inertia'],
+                        'score average': np.nanmean([group['score average'] for group in groups]),
+                        'silhouettes': silhouettes,
+                        'silhouette': np.mean(silhouettes)})
+    return results
+
+# Split any iterable into lists of at most batch_size items, without reading ahead
+def iter_batches(lists, batch_size):
+    iterator = iter(lists)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+# Mini-batch k-means, for more inputs than fit in memory at once
+# Inputs are read a batch at a time, e.g. from a generator, and each batch moves the means
+#     towards the inputs assigned to them
+# Every mean point keeps a count of the points it has been given, and moves by the batch's
+#     points over that count, so it ends up at the average of everything assigned to it
+# Only one batch of inputs, the means and the counts are held at any time
+class MiniBatchClusterer:
+    def __init__(self, n_groups, points_func=lambda x:x, batch_size=256, seed=None):
+        self.n_groups = n_groups
+        self.points_func = points_func
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.means = None
+        self.counts = None
+        self.score_sums = np.zeros(n_groups)
+        self.sizes = np.zeros(n_groups, dtype='int')
+        self.batches = 0
+        
+        # Inputs held back until there are enough to choose the starting means from
+        self._pending = []
+    
+    # Choose starting means with k-means++ on the first inputs, as in _fit_packed_points
+    def _start(self, points, points_mask):
+        labels = choose_seed_groups(points, points_mask, self.n_groups, self.rng)
+        self.means = []
+        for i in range(self.n_groups):
+            members = np.flatnonzero(labels == i)
+            if len(members) == 0:
+                members = self.rng.integers(len(points), size=1)
+            self.means.append(batch_mean_correspondence_distance(points[members],
+                                                                 points_mask[members]))
+        self.counts = [np.zeros(len(mean)) for mean in self.means]
+    
+    # Assign packed points to the nearest means, the first group winning ties
+    def _assign(self, points, points_mask):
+        packed_means, means_mask = pack_points(self.means, points.shape[2])
+        scores, assignments = batch_correspondence_distance(points, points_mask,
+                                                            packed_means, means_mask)
+        labels = np.argmin(scores, axis=1)
+        return labels, scores[np.arange(len(points)), labels], assignments[np.arange(len(points)), labels]
+    
+    # Update the means with one batch of inputs
+    def partial_fit(self, batch):
+        points_lists = [self.points_func(obj) for obj in batch]
+        if self.means is None:
+            self._pending.extend(points_lists)
+            if len(self._pending) < self.n_groups:
+                return self
+            points_lists = self._pending
+            self._pending = []
+            points, points_mask = pack_points(points_lists)
+            self._start(points, points_mask)
+        else:
+            points, points_mask = pack_points(points_lists)
+        if len(points_lists) == 0:
+            return self
+        
+        labels, scores, assignments = self._assign(points, points_mask)
+        np.add.at(self.score_sums, labels, scores)
+        np.add.at(self.sizes, labels, 1)
+        
+        # Add up the points given to each mean point, then move it towards their average
+        assigned = assignments >= 0
+        groups = np.broadcast_to(labels[:, np.newaxis], assignments.shape)[assigned]
+        slots = assignments[assigned]
+        for i in range(self.n_groups):
+            in_group = groups == i
+            if not in_group.any():
+                continue
+            sums = np.zeros(self.means[i].shape)
+            numbers = np.zeros(len(self.means[i]))
+            np.add.at(sums, slots[in_group], points[assigned][in_group])
+            np.add.at(numbers, slots[in_group], 1)
+            self.counts[i] += numbers
+            moved = numbers > 0
+            self.means[i][moved] += (sums[moved] - numbers[moved, np.newaxis] * self.means[i][moved]) / \
+                                    self.counts[i][moved, np.newaxis]
+        self.batches += 1
+        return self
+    
+    # Update the means with every input, read batch_size at a time
+    # Pass a function returning a new iterator to make more than one pass over the inputs
+    def fit(self, lists, passes=1):
+        for i in range(passes):
+            inputs = lists() if callable(lists) else lists
+            for batch in iter_batches(inputs, self.batch_size):
+                self.partial_fit(batch)
+        
+        # Start from however many inputs there were, if there were too few to fill every group
+        if self.means is None and len(self._pending) > 0:
+            points, points_mask = pack_points(self._pending)
+            self._pending = []
+            self._start(points, points_mask)
+        return self
+    
+    # Find the nearest group of new inputs, without changing the means
+    # Returns the group of each input, its score, and the mean point each of its points
+    #     corresponds to, or -1 if it has none
+    def predict(self, lists):
+        labels, scores, assignments = [], [], []
+        for batch in iter_batches(lists, self.batch_size):
+            points_lists = [self.points_func(obj) for obj in batch]
+            batch_labels, batch_scores, batch_assignments = self._assign(*pack_points(points_lists))
+            labels.append(batch_labels)
+            scores.append(batch_scores)
+            assignments.extend(list(assignment[:len(points)])
+                               for assignment, points in zip(batch_assignments, points_lists))
+        if len(labels) == 0:
+            return np.zeros(0, dtype='int'), np.zeros(0), []
+        return np.concatenate(labels), np.concatenate(scores), assignments
+    
+    # Describe the groups found so far
+    # The counts of each mean point stand in for the clusters kept by cluster_points
+    def groups(self):
+        result = []
+        for i in range(self.n_groups):
+            group = {'mean': [tuple(point) for point in self.means[i]],
+                     'slot counts': self.counts[i].astype('int').tolist(),
+                     'size': int(self.sizes[i]),
+                     'score sum': self.score_sums[i],
+                     'batches': self.batches}
+            if self.sizes[i] > 0:
+                group['score average'] = self.score_sums[i] / self.sizes[i]
+            else:
+                group['score average'] = float('nan')
+            result.append(group)
+        return result
+
+# Cluster inputs with mini-batch k-means, for when there are too many for cluster_points
+# lists can be any iterable, or a function returning a new iterator when passes > 1
+# Returns the fitted clusterer, which can assign new inputs with predict
+def mini_batch_cluster_points(lists, n_groups, points_func=lambda x:x, batch_size=256, passes=1,
+                              seed=None):
+    clusterer = MiniBatchClusterer(n_groups, points_func, batch_size, seed)
+    return clusterer.fit(lists, passes)
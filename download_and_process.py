@@ -1,402 +1,618 @@
 import numpy as np
 import enum
-import xml.etree.ElementTree as ElementTree
 import os
-import csv
 import re
-from shot import Shot
-import unicodedata
+import sys
+import argparse
 import ftplib
-from game import Game, Quarter
-from possession import Possession, PlayTypes
+import json
+import csv
+import hashlib
+import concurrent.futures
+import queue
+import threading
+import time
+from game import GAME_FILENAME, GAME_FORMAT_VERSION
+from roster import get_roster
+from season import update_season_index, INDEX_DIRNAME, INDEX_FILENAME
+from aggregate import aggregate_season
+from processing import process_game, save_game
+from profiling import GameProfile, write_log_records, summarize_records, print_summary
 
-# Download game files from the secondspectrum FTP server
-def download_game_files(game_codes):
-    # Login to the server
-    ftp = ftplib.FTP()
-    ftp.connect('sseupload.attcenter.com')
-    ftp.login(user='????????', passwd='????????')
-
-    # For each game code, download the below files
-    for game_code in game_codes:
-        filename_templates = [
-            'NBA_FINAL_ONCOURT${}.XML',
-            'NBA_FINAL_SEQUENCE_PBP_OPTICAL${}.XML',
-            'NBA_FINALBOX_OPTICAL${}.XML',
-            'NBA_FINALPBP_EXP${}.XML',
-        ]
-        for filename_template in filename_templates:
-            filename = filename_template.format(game_code)
+# The files that secondspectrum provides for every game
+FILENAME_TEMPLATES = [
+    'NBA_FINAL_ONCOURT${}.XML',
+    'NBA_FINAL_SEQUENCE_PBP_OPTICAL${}.XML',
+    'NBA_FINALBOX_OPTICAL${}.XML',
+    'NBA_FINALPBP_EXP${}.XML',
+]
+
+# The secondspectrum FTP server
+FTP_HOST = 'sseupload.attcenter.com'
+FTP_USER = '????????'
+FTP_PASSWD = '????????'
+
+# The record of processed and failed games, kept in the result directory
+MANIFEST_FILENAME = 'manifest.json'
+
+# The players file, and the saved matches between it and secondspectrum's players
+PLAYERS_FILENAME = 'players.csv'
+PLAYER_IDS_FILENAME = 'player_ids.json'
+
+# The version of the processing code, recorded with every processed game
+# Any edit to the processing modules already rebuilds every game, so only change it when what
+#     they produce changes for some other reason, e.g. a new version of a library
+PROCESSING_VERSION = 1
+
+# The modules whose code decides what a processed game contains
+# Only these are hashed, so editing the downloader, the command line or the loading code in
+#     game.py doesn't rebuild every game
+PROCESSING_MODULES = ['processing.py', 'possession.py', 'shot.py', 'roster.py']
+
+# The record of what a processed game was built from, kept in the game's directory
+BUILD_FILENAME = 'build.json'
+
+# The log of how long every stage of processing every game took, kept in the result directory
+# Every run adds one JSON line per game, and a line with the run's summary
+PROCESSING_LOG_FILENAME = 'processing log.jsonl'
+
+# The table of player aggregates over the season, kept in the season index's directory
+PLAYER_AGGREGATES_FILENAME = 'player aggregates.npy'
+
+# Keep a bounded pool of logged-in FTP connections that threads can share
+class FTPConnectionPool:
+    def __init__(self, host, user, passwd, size=4, port=21, timeout=60):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+    
+    def _connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(user=self.user, passwd=self.passwd)
+        return ftp
+    
+    # Borrow a connection, reusing an idle one if there is one
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+    
+    # Return a connection to the pool, or throw it away if it failed
+    def release(self, ftp, broken=False):
+        if broken:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+        else:
+            self._idle.put(ftp)
+        self._slots.release()
+    
+    def close(self):
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+# Download one file through the pool
+# Files already on disk with the same size as on the server are skipped, and partial files are resumed
+# Returns 'skipped' or 'downloaded'
+def download_file(pool, filename, local_dir, retries=3, backoff=1.0):
+    local_filename = os.path.join(local_dir, filename)
+    for attempt in range(retries + 1):
+        ftp = None
+        broken = False
+        try:
+            # Connecting can fail like any transfer, e.g. when the server has too many connections
+            ftp = pool.acquire()
+            ftp.voidcmd('TYPE I')
+            try:
+                remote_size = ftp.size(filename)
+            except ftplib.error_perm:
+                remote_size = None
+            local_size = os.path.getsize(local_filename) if os.path.exists(local_filename) else 0
+            if remote_size is not None and local_size == remote_size:
+                return 'skipped'
+            # Only resume when the partial file can be checked against the server
+            if remote_size is None or local_size > remote_size:
+                local_size = 0
+            
             print("Downloading {}".format(filename))
-            ftp.retrbinary('RETR {}'.format(filename),
-                           open(os.path.join('secondspectrum', filename), 'wb').write)
+            with open(local_filename, 'ab' if local_size > 0 else 'wb') as file:
+                ftp.retrbinary('RETR {}'.format(filename), file.write,
+                               rest=local_size if local_size > 0 else None)
+            return 'downloaded'
+        except ftplib.error_perm:
+            # The server refused, e.g. a missing file, so trying again won't help
+            if os.path.exists(local_filename) and os.path.getsize(local_filename) == 0:
+                os.remove(local_filename)
+            raise
+        except (ftplib.Error, OSError, EOFError) as e:
+            broken = True
+            if attempt == retries:
+                raise
+            delay = backoff * 2**attempt
+            print("Retrying {} in {:.1f}s ({})".format(filename, delay, e))
+            time.sleep(delay)
+        finally:
+            if ftp is not None:
+                pool.release(ftp, broken)
 
-    ftp.quit()
+# Download game files from the secondspectrum FTP server
+# Uses a pool of connections to download several files at once
+# Returns a list of (filename, error) for the files that could not be downloaded
+def download_game_files(game_codes, secondspectrum_dir='secondspectrum',
+                        host=FTP_HOST, user=FTP_USER, passwd=FTP_PASSWD, port=21,
+                        connections=4, retries=3, backoff=1.0):
+    os.makedirs(secondspectrum_dir, exist_ok=True)
+    filenames = [filename_template.format(game_code)
+                 for game_code in game_codes
+                 for filename_template in FILENAME_TEMPLATES]
+    
+    pool = FTPConnectionPool(host, user, passwd, size=connections, port=port)
+    failed = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = {executor.submit(download_file, pool, filename, secondspectrum_dir,
+                                       retries, backoff): filename
+                       for filename in filenames}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print("Failed to download {}: {}".format(futures[future], e))
+                    failed.append((futures[future], repr(e)))
+    finally:
+        pool.close()
+    
+    return failed
 
 # Read all the game codes from the game_codes file
-def read_game_codes():
+def read_game_codes(filename='secondspectrum/game_codes.txt'):
     game_codes = []
-    with open('secondspectrum/game_codes.txt', 'rt') as file:
+    with open(filename, 'rt') as file:
         for line in file:
-            game_code = re.match('\d+', line)[0]
-            game_codes.append(game_code)
+            match = re.match(r'\d+', line)
+            if match:
+                game_codes.append(match[0])
     return game_codes
 
-# Process the XMl files to produce more useable numpy arrays
-def process_secondspectrum_games(secondspectrum_dir, result_dir):
-    # Build a list of game codes that are actually downloaded
+# Find the codes of the games whose files are downloaded
+def downloaded_game_codes(secondspectrum_dir):
     game_codes = []
     for filename in os.listdir(secondspectrum_dir):
         if filename.startswith("NBA_FINAL_ONCOURT$") and filename.endswith(".XML"):
             game_code = filename.replace("NBA_FINAL_ONCOURT$", "").replace(".XML", "")
             game_codes.append(game_code)
-    
-    number_processed = 0
-    for game_code in game_codes:
-        game = Game(game_code)
-        
-        # Get the player data for this game
-        players_data = read_player_data(
-            secondspectrum_dir,
-            game_code)
-        game.players = players_data
-        
-        # Get the teams data for this game
-        teams_data = read_teams_data(
-            secondspectrum_dir,
-            game_code)
-        game.teams = teams_data
-        
-        for quarter in range(1,5):
-            game.quarters[quarter] = Quarter()
-            
-            # Get the events data for this quarter
-            try:
-                events_data = read_pbp_data(
-                    secondspectrum_dir,
-                    game_code,
-                    quarter,
-                    teams_data,
-                    players_data)
-            except StopIteration:
-                continue
-            game.quarters[quarter].events = events_data
-            
-            # Get the shots data for this quarter
-            shots_data = read_shots(
-                secondspectrum_dir,
-                game_code,
-                quarter,
-                players_data,
-                events_data)
-            game.quarters[quarter].shots = shots_data
-            
-            # Get the possessions data for this quarter
-            possessions_data = read_possessions_data(
-                secondspectrum_dir,
-                game_code,
-                quarter,
-                players_data,
-                events_data,
-                shots_data)
-            game.quarters[quarter].possessions = possessions_data
-            
-        np.save(os.path.join(result_dir, '{}.npy'.format(game_code)), game)
-        
-        number_processed += 1
-        print("{}/{}".format(number_processed, len(game_codes)))
-
-def read_pbp_data(dirname, game_code, quarter, teams_data, players_data):
-    # Read the play-by-play document
-    pbp_filename = 'NBA_FINAL_SEQUENCE_PBP_OPTICAL${}.XML'.format(game_code)
-    document = ElementTree.parse(os.path.join(dirname, pbp_filename))
-
-    sports_statistics = document.getroot()
-    sports_boxscores = next(c for c in sports_statistics if c.tag == 'sports-boxscores')
-    nba_boxscores = next(c for c in sports_boxscores if c.tag == 'nba-boxscores')
-    nba_boxscore = next(c for c in nba_boxscores if c.tag == 'nba-boxscore')
-    moments = next(c for c in nba_boxscore
-                   if c.tag == 'sequence-pbp' and c.attrib['period'] == '{}'.format(quarter))
-    
-    # Compile all the data into a numpy table
-    events_result_structure = [('shot clock', 'float'), ('game clock', 'float'),
-                               ('event player id', 'int'), ('event team id', 'int'),
-                               ('event type', 'int')]
-    events_result = np.zeros(len(moments), dtype=events_result_structure)
-    
-    # For every moment in the file
-    i = 0
-    for moment in moments:
-        # Read the data from the moment
-        event_time = float(moment.attrib['game-clock'])
-        event_type = int(moment.attrib['event-id'])
-        event_player = int(moment.attrib['global-player-id'])
-        shot_clock = float(moment.attrib['shot-clock']) if len(moment.attrib['shot-clock']) > 0 else 0
-
-        # Record the event
-        events_result[i]['game clock'] = event_time
-        events_result[i]['shot clock'] = shot_clock
-        events_result[i]['event player id'] = event_player
-        events_result[i]['event type'] = event_type
-        if event_player in players_data:
-            events_result[i]['event team id'] = players_data[event_player]['team id']
+    return game_codes
+
+# Game codes have this many digits, so shorter numbers are indices into the list of game codes
+GAME_CODE_DIGITS = 10
+
+# Pick games from a list of game codes
+# Every part of the selection is 'all', a game code, an index like '5', or a range of indices
+#     like '5:10' for games 5 to 9, where either end can be left out
+# Returns the picked game codes in order, each only once
+def select_game_codes(game_codes, selection):
+    selected = []
+    for part in selection:
+        if part == 'all':
+            codes = game_codes
+        elif part in game_codes:
+            codes = [part]
+        elif re.match(r'^\d+$', part) and len(part) >= GAME_CODE_DIGITS:
+            raise ValueError("Game {} isn't in the game codes".format(part))
+        elif re.match(r'^\d+$', part):
+            index = int(part)
+            if index >= len(game_codes):
+                raise ValueError("There is no game {}, only {} games".format(index, len(game_codes)))
+            codes = [game_codes[index]]
+        elif re.match(r'^(\d*):(\d*)$', part):
+            start, stop = re.match(r'^(\d*):(\d*)$', part).groups()
+            codes = game_codes[int(start) if start else None:int(stop) if stop else None]
         else:
-            print("Unidentified player {}".format(event_player))
-            events_result[i]['event team id'] = 0
-        i += 1
-    # Remove excess rows
-    events_result.resize((i,))
-    
-    return events_result
+            raise ValueError("I didn't understand the game selection {}".format(part))
+        for game_code in codes:
+            if game_code not in selected:
+                selected.append(game_code)
+    return selected
 
-def read_player_data(dirname, game_code):
-    players_result = {}
-    
-    # Read the oncourt document
-    oncourt_filename = 'NBA_FINAL_ONCOURT${}.XML'.format(game_code)
-    document = ElementTree.parse(os.path.join(dirname, oncourt_filename))
-    sports_statistics = document.getroot()
-    sports_oncourt = next(c for c in sports_statistics if c.tag == 'sports-oncourt')
-    nba_oncourt = next(c for c in sports_oncourt if c.tag == 'nba-oncourt')
-    nba_oncourt_players = next(c for c in nba_oncourt if c.tag == 'nba-oncourt-players')
-    
-    visiting_team = next(c for c in nba_oncourt_players if c.tag == 'visiting-team')
-    away_id = next(c for c in visiting_team if c.tag == 'team-code').attrib['global-id']
-    
-    home_team = next(c for c in nba_oncourt_players if c.tag == 'home-team')
-    home_id = next(c for c in visiting_team if c.tag == 'team-code').attrib['global-id']
-
-    # Find the name of the players in this game
-    temp_players = []
-    for oncourt in [c for c in nba_oncourt_players if c.tag == 'oncourt']:
-        teams = [(next(c for c in oncourt if c.tag == 'visiting-team-players'), away_id),
-                 (next(c for c in oncourt if c.tag == 'home-team-players'), home_id)]
-        for team, team_id in teams:
-            for player in team:
-                name = strip_accents(player.attrib['display-name'].replace('.', ''))
-                player_id = int(player.attrib['global-id'])
-                temp_players.append((name, player_id, team_id))
-
-    # Add every referenced player from the CSV file
-    csv_rows = []
-    with open('players.csv', 'rt') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for ordered_row in csv_reader:
-            row = dict(ordered_row)
-            csv_rows.append(row)
-    
-    # Reorganize the players data to fit into the data from the players file
-    for name, player_id, team_id in temp_players:
-        scores = [score_name_similarity(name, csv_row['name']) for csv_row in csv_rows]
-        best_score = max(scores)
-        if best_score == 0:
-            print('{} not found'.format(name))
-        best_score_index = scores.index(best_score)
-        best_score_row = csv_rows[best_score_index]
-        players_result[player_id] = best_score_row
-        players_result[player_id]['team id'] = team_id
+# Process the XMl files to produce more useable numpy arrays
+# Use stream=True to read the large documents incrementally instead of building their trees
+# Use workers > 1 to process games in parallel worker processes
+# Games already processed from the same XML files, players file and processing code are skipped,
+#     unless force=True
+# Progress is recorded in a manifest in result_dir, so an interrupted run resumes where it stopped
+# The time of every stage of every game is logged in result_dir and summarized at the end
+# Give a profile_dir to also save cProfile stats of every stage of every game there
+# Give game_codes to only process some of the downloaded games
+def process_secondspectrum_games(secondspectrum_dir, result_dir, stream=False, workers=1,
+                                 force=False, profile_dir=None, game_codes=None):
+    # Build a list of game codes that are actually downloaded
+    downloaded = downloaded_game_codes(secondspectrum_dir)
+    if game_codes is None:
+        game_codes = downloaded
+    else:
+        game_codes = [game_code for game_code in game_codes if game_code in downloaded]
     
-    return players_result
-
-# Remove accents from a string
-def strip_accents(s):
-    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
-
-def read_possessions_data(dirname, game_code, quarter, players_data, events_data, shots_data):
-    # Read the box document
-    box_filename = 'NBA_FINALBOX_OPTICAL${}.XML'.format(game_code)
-    document_box = ElementTree.parse(os.path.join(dirname, box_filename))
-    sports_statistics_box = document_box.getroot()
-    sports_boxscores = next(c for c in sports_statistics_box if c.tag == 'sports-boxscores')
-    nba_boxscores = next(c for c in sports_boxscores if c.tag == 'nba-boxscores')
-    nba_boxscore = next(c for c in nba_boxscores if c.tag == 'nba-boxscore')
-    possessions = next(c for c in nba_boxscore if c.tag == 'possessions')
-    quarter_el = next(c for c in possessions
-                      if c.tag == 'quarter' and int(c.attrib['number']) == quarter)
+    # Skip the games that don't need to be processed again
+    os.makedirs(result_dir, exist_ok=True)
+    manifest = read_manifest(result_dir)
+    players_hash = file_hash(PLAYERS_FILENAME)
+    todo = []
+    for game_code in sorted(game_codes):
+        if not force and is_game_up_to_date(secondspectrum_dir, result_dir, game_code, players_hash):
+            if game_code not in manifest['done']:
+                manifest['done'].append(game_code)
+            continue
+        todo.append(game_code)
+    print("{} games up to date, {} to process".format(len(game_codes) - len(todo), len(todo)))
     
-    possessions_result = []
+    # Keep the matched player ids between runs
+    ids_filename = os.path.join(result_dir, PLAYER_IDS_FILENAME)
+    roster = get_roster(PLAYERS_FILENAME, ids_filename)
     
-    # For each possession, record start and end time
-    # then make a processeable thread for it, and record all the shots
-    for possession_el in [c for c in quarter_el if c.tag == 'possession']:
-        new_possession = Possession(game_code, quarter, int(possession_el.attrib['team-global-id']))
-        
-        start_time = float(possession_el.attrib['time-start'].split(':')[0])*60 + \
-                     float(possession_el.attrib['time-start'].split(':')[1])
-        end_time = float(possession_el.attrib['time-end'].split(':')[0])*60 + \
-                   float(possession_el.attrib['time-end'].split(':')[1])
-        
-        new_possession.events_raw = events_data[np.logical_and(
-            start_time > events_data['game clock'],
-            events_data['game clock'] > end_time)]
-        new_possession.make_thread(new_possession.events_raw, players_data)
+    # Record the result of every game as soon as it finishes
+    number_processed = 0
+    log_filename = os.path.join(result_dir, PROCESSING_LOG_FILENAME)
+    records = []
+    start = time.perf_counter()
+    def record_result(game_code, error, new_ids=None, record=None):
+        nonlocal number_processed
+        if new_ids:
+            roster.update(new_ids)
+        if record is None:
+            record = {'game': game_code, 'error': error, 'wall': None, 'stages': {}, 'counts': {},
+                      'peak memory': None}
+        records.append(record)
+        write_log_records(log_filename, [record])
+        if game_code in manifest['done']:
+            manifest['done'].remove(game_code)
+        manifest['failed'].pop(game_code, None)
+        if error is None:
+            manifest['done'].append(game_code)
+        else:
+            manifest['failed'][game_code] = error
+            print("Failed to process {}: {}".format(game_code, error))
+        write_manifest(result_dir, manifest)
         
-        new_possession.shots = []
-        for shot in shots_data:
-            if shot.event in new_possession.events_raw:
-                new_possession.shots.append(shot)
-                
-        possessions_result.append(new_possession)
-    return possessions_result
-
-def read_teams_data(dirname, game_code):
-    teams_result = {}
+        number_processed += 1
+        print("{}/{}".format(number_processed, len(todo)))
     
-    # Read the oncourt document
-    oncourt_filename = 'NBA_FINAL_ONCOURT${}.XML'.format(game_code)
-    document = ElementTree.parse(os.path.join(dirname, oncourt_filename))
-    sports_statistics = document.getroot()
-    sports_oncourt = next(c for c in sports_statistics if c.tag == 'sports-oncourt')
-    nba_oncourt = next(c for c in sports_oncourt if c.tag == 'nba-oncourt')
-    nba_oncourt_players = next(c for c in nba_oncourt if c.tag == 'nba-oncourt-players')
-
-    # Find the home team
-    home_team_tag = next(c for c in nba_oncourt_players if c.tag == 'home-team')
-    home_team_city = next(c for c in home_team_tag if c.tag == 'team-city').attrib['city']
-    home_team_name = next(c for c in home_team_tag if c.tag == 'team-name').attrib['name']
-    home_team_id = next(c for c in home_team_tag if c.tag == 'team-code').attrib['global-id']
-    teams_result['home'] = {'name': home_team_name,
-                            'city': home_team_city,
-                            'id': home_team_id}
-
-    # Find the away team
-    away_team_tag = next(c for c in nba_oncourt_players if c.tag == 'visiting-team')
-    away_team_city = next(c for c in away_team_tag if c.tag == 'team-city').attrib['city']
-    away_team_name = next(c for c in away_team_tag if c.tag == 'team-name').attrib['name']
-    away_team_id = next(c for c in away_team_tag if c.tag == 'team-code').attrib['global-id']
-    teams_result['away'] = {'name': away_team_name,
-                            'city': away_team_city,
-                            'id': away_team_id}
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_and_save_game, secondspectrum_dir, result_dir,
+                                       game_code, stream, ids_filename, players_hash,
+                                       profile_dir): game_code
+                       for game_code in todo}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    record_result(*future.result())
+                except Exception as e:
+                    # The worker itself died, rather than the game failing
+                    record_result(futures[future], repr(e))
+    else:
+        for game_code in todo:
+            record_result(*process_and_save_game(secondspectrum_dir, result_dir, game_code, stream,
+                                                 ids_filename, players_hash, profile_dir))
     
-    return teams_result
-
-# Score how similar two names are, to deal with inexact matches
-def score_name_similarity(a, b):
-    a_split = a.split(' ')
-    b_split = b.split(' ')
-    result = 0
-    for word in a_split:
-        if word in b_split:
-            result += 1
-    return result
-
-def read_shots(dirname, game_code, quarter, players_data, events_data):
-    # Read the pbp document
-    pbp_filename = 'NBA_FINALPBP_EXP${}.XML'.format(game_code)
-    document = ElementTree.parse(os.path.join(dirname, pbp_filename))
-    sports_statistics = document.getroot()
-    sports_scores = next(c for c in sports_statistics if c.tag == 'sports-scores')
-    nba_scores = next(c for c in sports_scores if c.tag == 'nba-scores')
-    nba_pbp = next(c for c in nba_scores if c.tag == 'nba-playbyplay')
+    if len(roster.new_ids) > 0:
+        roster.save()
     
-    # Read the box document
-    box_filename = 'NBA_FINALBOX_OPTICAL${}.XML'.format(game_code)
-    document_box = ElementTree.parse(os.path.join(dirname, box_filename))
-    sports_statistics_box = document_box.getroot()
-    sports_boxscores = next(c for c in sports_statistics_box if c.tag == 'sports-boxscores')
-    nba_boxscores = next(c for c in sports_boxscores if c.tag == 'nba-boxscores')
-    nba_boxscore = next(c for c in nba_boxscores if c.tag == 'nba-boxscore')
+    if len(records) > 0:
+        summary = summarize_records(records, time.perf_counter() - start)
+        write_log_records(log_filename, [{'summary': summary}])
+        print_summary(summary)
     
-    # Compile all the data
-    shots_result = []
+    return manifest
 
-    # For every play in the file
-    for play in [c for c in nba_pbp if c.tag == 'play']:
-        # Only look at the requested quarter
-        if int(play.attrib['quarter']) != quarter:
-            continue
-        
-        # Only look at shots
-        event_id = int(play.attrib['event-id'])
-        if event_id != PlayTypes.FIELD_GOAL_MADE and event_id != PlayTypes.FIELD_GOAL_MISSED:
-            continue
-        
-        # Compute the time and link to the events
-        time = float(play.attrib['time-minutes'])*60 + float(play.attrib['time-seconds'])
-        event_index = np.argmin(np.abs(events_data['game clock'] - time))
-        event = events_data[event_index]
-        
-        # Cross reference to find the shot in the shots file
-        best_shot_from_file = None
-        best_shot_from_file_dist = 100000000.0
-        for players_team in [c for c in nba_boxscore if c.tag == 'players']:
-            for player in [c for c in players_team if c.tag == 'player']:
-                try:
-                    shot_log = next(c for c in player if c.tag == 'shot-log')
-                except StopIteration:
-                    continue
-                for shot_from_file in [c for c in shot_log if c.tag == 'shot']:
-                    shot_from_file_time = float(shot_from_file.attrib['game-clock'].split(':')[0])*60 + float(shot_from_file.attrib['game-clock'].split(':')[1])
-                    shot_from_file_dist = abs(time - shot_from_file_time)
-                    if shot_from_file_dist < best_shot_from_file_dist:
-                        best_shot_from_file_dist = shot_from_file_dist
-                        best_shot_from_file = shot_from_file
-        if best_shot_from_file is None:
-            print("Can't find shot for event at time {}".format(events_data['game clock']))
+# Bring the season index and the player aggregates of the processed games up to date
+# Only the games that were saved since the last update are read again, and the aggregates are
+#     only recomputed when they are older than the index
+def update_season(result_dir, index_dir=None):
+    if index_dir is None:
+        index_dir = os.path.join(result_dir, INDEX_DIRNAME)
+    index, changed = update_season_index(result_dir, index_dir)
+    print("{} games added to the season index".format(len(changed)))
+    aggregates_filename = os.path.join(index_dir, PLAYER_AGGREGATES_FILENAME)
+    if not os.path.exists(aggregates_filename) or \
+            os.path.getmtime(aggregates_filename) < \
+            os.path.getmtime(os.path.join(index_dir, INDEX_FILENAME)):
+        table, _ = aggregate_season(index)
+        with open(aggregates_filename + '.tmp', 'wb') as file:
+            np.save(file, table)
+        os.replace(aggregates_filename + '.tmp', aggregates_filename)
+    return index
+
+# Process a single game and save it to the result directory, with a record of what it was built from
+# The XML files are hashed before they are read, so a file changed while processing is seen as stale
+# Returns the game code, None or a description of the error, the newly matched player ids, and
+#     the game's record for the processing log
+def process_and_save_game(secondspectrum_dir, result_dir, game_code, stream=False,
+                          ids_filename=None, players_hash=None, profile_dir=None):
+    roster = get_roster(PLAYERS_FILENAME, ids_filename)
+    profile = GameProfile(game_code, profile_dir)
+    try:
+        with profile.stage('hash'):
+            build_info = {'version': PROCESSING_VERSION,
+                          'code': processing_code_hash(),
+                          'players': players_hash,
+                          'sources': describe_sources(secondspectrum_dir, game_code)}
+        game = process_game(secondspectrum_dir, game_code, stream=stream, roster=roster,
+                            profile=profile)
+        with profile.stage('save'):
+            # Forget what the old game was built from before replacing it, so a game that is
+            #     only partly saved is never taken to be up to date
+            remove_build_info(result_dir, game_code)
+            save_game(game, os.path.join(result_dir, game_code))
+            write_build_info(result_dir, game_code, build_info)
+    except Exception as e:
+        return game_code, repr(e), roster.take_new_ids(), profile.record(repr(e))
+    return game_code, None, roster.take_new_ids(), profile.record()
+
+# Hash the contents of a file
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Hash the source of the processing modules, so games processed by other code are rebuilt
+# The hash is only computed once per process
+_processing_code_hash = None
+def processing_code_hash():
+    global _processing_code_hash
+    if _processing_code_hash is None:
+        digest = hashlib.sha1()
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        for module in PROCESSING_MODULES:
+            digest.update(module.encode())
+            digest.update(file_hash(os.path.join(module_dir, module)).encode())
+        _processing_code_hash = digest.hexdigest()
+    return _processing_code_hash
+
+# Describe the XML files a game is made from, with the hash of each one
+# A file whose size and time match a previous description keeps its hash, rather than reading it
+def describe_sources(secondspectrum_dir, game_code, previous=None):
+    previous = previous or {}
+    sources = {}
+    for filename_template in FILENAME_TEMPLATES:
+        filename = filename_template.format(game_code)
+        path = os.path.join(secondspectrum_dir, filename)
+        if not os.path.exists(path):
             continue
-        dribbles = int(best_shot_from_file.attrib['dribbles'])
-        defender_dist = float(next(c for c in best_shot_from_file
-                                   if c.tag == 'closest-defender').attrib['defender-distance'])
-        if len(best_shot_from_file.attrib['x-coordinate']) > 0 and \
-           len(best_shot_from_file.attrib['y-coordinate']) > 0:
-            position = [float(best_shot_from_file.attrib['x-coordinate']),
-                        float(best_shot_from_file.attrib['y-coordinate'])]
-        else:
-            position = [float('nan'), float('nan')]
-        if len(best_shot_from_file.attrib['shot-distance']):
-            shot_dist = float(best_shot_from_file.attrib['shot-distance'])
+        stat = os.stat(path)
+        old = previous.get(filename)
+        if old is not None and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+            sources[filename] = old
         else:
-            shot_dist = 10000
-        
-        # Record the shot details
-        description = play.attrib['detail-description']
-        shooter_id = int(play.attrib['global-player-id-1'])
-        shooter = players_data[shooter_id]
-        new_shot = Shot(event, position, description, shooter)
-        new_shot.result = 1 if best_shot_from_file.attrib['result'] == 'made' else 0
-        new_shot.points = int(best_shot_from_file.attrib['points-type'])
-        
-        # Compute shot quality
-        new_shot.calculate_shot_quality(dribbles, defender_dist, shot_dist)
-        
-        shots_result.append(new_shot)
-    return shots_result
+            sources[filename] = {'sha1': file_hash(path), 'size': stat.st_size,
+                                 'mtime': stat.st_mtime}
+    return sources
 
-# Make a command line interface
-if __name__ == '__main__':
-    print("This program can download and process secondspectrum data")
+# Read the record of what a processed game was built from, or None if there isn't one
+def read_build_info(result_dir, game_code):
+    try:
+        with open(os.path.join(result_dir, game_code, BUILD_FILENAME), 'rt') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+# Write the record of what a processed game was built from
+def write_build_info(result_dir, game_code, build_info):
+    filename = os.path.join(result_dir, game_code, BUILD_FILENAME)
+    with open(filename + '.tmp', 'wt') as file:
+        json.dump(build_info, file, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+# Remove the record of what a processed game was built from, if there is one
+def remove_build_info(result_dir, game_code):
+    try:
+        os.remove(os.path.join(result_dir, game_code, BUILD_FILENAME))
+    except FileNotFoundError:
+        pass
+
+# Check whether a processed game was built from the same XML files, players file and processing
+#     code as it would be now
+# Files are compared by their hashes, so a file that was only touched doesn't count as changed
+def is_game_up_to_date(secondspectrum_dir, result_dir, game_code, players_hash=None):
+    result_filename = os.path.join(result_dir, game_code, GAME_FILENAME)
+    if not os.path.exists(result_filename):
+        return False
     
-    while True:
-        print("Which games should I download?")
-        print("(\'5\' to download game 5, \'5:10\' to download games 5 to 9, \'all\' to download all games, or <enter> to skip)")
-        download_response = input('> ')
-
-        game_codes = read_game_codes()
-        if download_response == "":
-            break
-        elif download_response == "all":
-            download_game_files(game_codes)
-        elif re.match('^(\d+):(\d+)$', download_response):
-            start_index = int(re.match('^(\d+):(\d+)$', download_response).group(1))
-            end_index = int(re.match('^(\d+):(\d+)$', download_response).group(2))
-            download_game_files(game_codes[start_index:end_index])
-            break
-        elif re.match('^(\d+)$', download_response):
-            index = int(re.match('^(\d+)$', download_response).group(1))
-            download_game_files(game_codes[index])
-            break
-        else:
-            print("I didn't understand that.")
+    # Games saved with an older layout are missing columns
+    try:
+        with open(result_filename, 'rt') as file:
+            if json.load(file).get('format', 1) < GAME_FORMAT_VERSION:
+                return False
+    except ValueError:
+        return False
     
-    while True:
-        print("Should I process the data?")
-        print("(y to process, n to skip)")
-        process_response = input('> ')
-
-        if process_response == "y":
-            process_secondspectrum_games('secondspectrum', 'processed_data')
-            break
-        elif process_response == "n":
-            break
-        else:
-            print("I didn't understand that.")
\ No newline at end of file
+    build_info = read_build_info(result_dir, game_code)
+    if build_info is None or build_info.get('version') != PROCESSING_VERSION or \
+            build_info.get('code') != processing_code_hash():
+        return False
+    if players_hash is not None and build_info.get('players') != players_hash:
+        return False
+    sources = describe_sources(secondspectrum_dir, game_code, build_info['sources'])
+    if {filename: source['sha1'] for filename, source in sources.items()} != \
+       {filename: source['sha1'] for filename, source in build_info['sources'].items()}:
+        return False
+    
+    # Remember the new times of touched files, so they aren't hashed again next time
+    if sources != build_info['sources']:
+        build_info['sources'] = sources
+        write_build_info(result_dir, game_code, build_info)
+    return True
+
+# Read the record of which games have been processed, and which failed
+def read_manifest(result_dir):
+    try:
+        with open(os.path.join(result_dir, MANIFEST_FILENAME), 'rt') as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    manifest.setdefault('done', [])
+    manifest.setdefault('failed', {})
+    return manifest
+
+# Write the manifest, replacing the old one in a single step so a crash can't corrupt it
+def write_manifest(result_dir, manifest):
+    filename = os.path.join(result_dir, MANIFEST_FILENAME)
+    with open(filename + '.tmp', 'wt') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+# Save the player aggregates in another format, with each player's name and team
+def export_player_aggregates(table, players, filename, output_format):
+    rows = []
+    for row in table:
+        player = players.get(int(row['player id']), {})
+        record = {'name': player.get('name'), 'team': player.get('team')}
+        record.update({name: row[name].item() for name in table.dtype.names})
+        rows.append(record)
+    if output_format == 'json':
+        with open(filename, 'wt') as file:
+            json.dump(rows, file, indent=1)
+    elif output_format == 'csv':
+        with open(filename, 'wt', newline='') as file:
+            writer = csv.DictWriter(file, ['name', 'team'] + list(table.dtype.names))
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        raise ValueError('Unknown output format {}'.format(output_format))
+
+# Add the options for picking games to a command
+def _add_game_arguments(parser):
+    parser.add_argument('--games', nargs='+', metavar='GAMES',
+                        help="'all', game codes, indices like 5, or ranges like 5:10 into the "
+                             "game codes file")
+    parser.add_argument('--codes-file', default='secondspectrum/game_codes.txt',
+                        help='the file of game codes that --games picks from')
+
+# Pick the games given on the command line, stopping with a usage error if they don't make sense
+def _selected_game_codes(args, game_codes):
+    try:
+        return select_game_codes(game_codes, args.games)
+    except ValueError as e:
+        args.parser.error(str(e))
+
+def _download_command(args):
+    game_codes = _selected_game_codes(args, read_game_codes(args.codes_file))
+    print("Downloading {} games".format(len(game_codes)))
+    failed = download_game_files(game_codes, args.secondspectrum_dir,
+                                 connections=args.connections, retries=args.retries)
+    return 1 if failed else 0
+
+def _process_command(args):
+    game_codes = None
+    missing = []
+    if args.games is not None:
+        # Indices go into the game codes file, and downloaded games can also be picked by code
+        downloaded = downloaded_game_codes(args.secondspectrum_dir)
+        known_codes = read_game_codes(args.codes_file) if os.path.exists(args.codes_file) else []
+        known_codes += sorted(set(downloaded) - set(known_codes))
+        game_codes = _selected_game_codes(args, known_codes)
+        missing = [game_code for game_code in game_codes if game_code not in downloaded]
+        for game_code in missing:
+            print("Game {} is not downloaded".format(game_code))
+    manifest = process_secondspectrum_games(args.secondspectrum_dir, args.result_dir,
+                                            stream=args.stream, workers=args.workers,
+                                            force=args.force, profile_dir=args.profile_dir,
+                                            game_codes=game_codes)
+    failed = [game_code for game_code in manifest['failed']
+              if game_codes is None or game_code in game_codes]
+    return 1 if failed or missing else 0
+
+def _index_command(args):
+    index_dir = args.index_dir or os.path.join(args.result_dir, INDEX_DIRNAME)
+    if args.rebuild and os.path.exists(os.path.join(index_dir, INDEX_FILENAME)):
+        os.remove(os.path.join(index_dir, INDEX_FILENAME))
+    index, changed = update_season_index(args.result_dir, index_dir)
+    print("{} games added to the season index".format(len(changed)))
+    return 0
+
+def _aggregate_command(args):
+    index = update_season(args.result_dir, args.index_dir)
+    if args.format == 'npy' and args.output is None:
+        print("Saved the player aggregates in {}".format(
+            os.path.join(index.index_dir, PLAYER_AGGREGATES_FILENAME)))
+        return 0
+    table, players = aggregate_season(index)
+    output = args.output or os.path.join(index.index_dir, 'player aggregates.{}'.format(args.format))
+    if args.format == 'npy':
+        np.save(output, table)
+    else:
+        export_player_aggregates(table, players, output, args.format)
+    print("Saved the player aggregates in {}".format(output))
+    return 0
+
+# Run one of the commands, without asking anything, so it can run from a scheduler
+# Returns the exit code: 0 if everything worked, 1 if any game failed, and 2 for bad arguments
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download and process secondspectrum data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    download_parser = subparsers.add_parser('download', help='download game files by FTP')
+    _add_game_arguments(download_parser)
+    download_parser.set_defaults(games=['all'])
+    download_parser.add_argument('--secondspectrum-dir', default='secondspectrum')
+    download_parser.add_argument('--connections', type=int, default=4,
+                                 help='how many files to download at once')
+    download_parser.add_argument('--retries', type=int, default=3)
+    download_parser.set_defaults(run=_download_command, parser=download_parser)
+
+    process_parser = subparsers.add_parser('process', help='process downloaded games')
+    _add_game_arguments(process_parser)
+    process_parser.add_argument('--secondspectrum-dir', default='secondspectrum')
+    process_parser.add_argument('--result-dir', default='processed_data')
+    process_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                                help='how many games to process at once')
+    process_parser.add_argument('--stream', action='store_true',
+                                help='read the documents incrementally, to use less memory')
+    process_parser.add_argument('--force', action='store_true',
+                                help='process games again even if they are up to date')
+    process_parser.add_argument('--profile-dir',
+                                help='save cProfile stats of every stage of every game here')
+    process_parser.set_defaults(run=_process_command, parser=process_parser)
+
+    index_parser = subparsers.add_parser('index', help='update the season index')
+    index_parser.add_argument('--result-dir', default='processed_data')
+    index_parser.add_argument('--index-dir',
+                              help="where to keep the index, by default in the result directory")
+    index_parser.add_argument('--rebuild', action='store_true',
+                              help='read every game again instead of only the changed ones')
+    index_parser.set_defaults(run=_index_command, parser=index_parser)
+
+    aggregate_parser = subparsers.add_parser('aggregate',
+                                             help='update the season index and player aggregates')
+    aggregate_parser.add_argument('--result-dir', default='processed_data')
+    aggregate_parser.add_argument('--index-dir',
+                                  help="where to keep the index, by default in the result directory")
+    aggregate_parser.add_argument('--format', choices=['npy', 'csv', 'json'], default='npy')
+    aggregate_parser.add_argument('--output', help='where to save the player aggregates')
+    aggregate_parser.set_defaults(run=_aggregate_command, parser=aggregate_parser)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,42 @@
 import numpy as np
 import os
 import re
+import json
+import datetime
+import collections
+import collections.abc
+import concurrent.futures
+import threading
+from possession import Possession, Thread
+from shot import Shot, get_shot_quality_model, DEFAULT_SHOT_QUALITY_MODEL
+
+# The columns of the tables a processed game is saved as
+EVENTS_STRUCTURE = [('shot clock', 'float'), ('game clock', 'float'),
+                    ('event player id', 'int'), ('event team id', 'int'),
+                    ('event type', 'int')]
+POSSESSIONS_STRUCTURE = [('quarter', 'int8'), ('team id', 'int64'),
+                         ('events start', 'int32'), ('events stop', 'int32'),
+                         ('holds start', 'int32'), ('holds stop', 'int32'),
+                         ('shots start', 'int32'), ('shots stop', 'int32')]
+SHOTS_STRUCTURE = [('quarter', 'int8'), ('event index', 'int32'),
+                   ('x', 'float'), ('y', 'float'), ('classification', 'int32'),
+                   ('shooter id', 'int64'), ('result', 'int8'), ('points', 'int8'),
+                   ('quality', 'float'), ('dribbles', 'int16'), ('defender distance', 'float'),
+                   ('shot distance', 'float')]
+
+# The tables of a processed game, each in its own .npy file
+# possession events and possession shots list the quarter's events and shots in each possession
+TABLE_NAMES = ['events', 'possessions', 'possession events', 'holds', 'shots', 'possession shots']
+
+# The small, non-tabular parts of a processed game
+GAME_FILENAME = 'game.json'
+
+# The version of the tables' layout; games saved with an older layout are processed again
+# 2 added the inputs of the shot quality models to the shots table
+GAME_FORMAT_VERSION = 2
+
+# The directory in a processed game where shot qualities from each model are saved
+QUALITY_DIRNAME = 'quality'
 
 # Use this class to store a game
 class Game:
@@ -10,6 +46,27 @@ class Game:
         self.players = None
         self.teams = None
         self.misc = {}
+        self.tables = None
+        self.quality_model = None
+
+    # A game loaded from tables only builds its quarters when they are first used
+    @property
+    def quarters(self):
+        if self._quarters is None:
+            self._quarters = quarters_from_tables(self)
+        return self._quarters
+
+    @quarters.setter
+    def quarters(self, quarters):
+        self._quarters = quarters
+
+    # Games pickled before the tables existed stored their quarters directly
+    def __setstate__(self, state):
+        if 'quarters' in state:
+            state['_quarters'] = state.pop('quarters')
+        state.setdefault('tables', None)
+        state.setdefault('quality_model', None)
+        self.__dict__.update(state)
 
 # Use this class to store a quarter
 class Quarter:
@@ -23,17 +80,248 @@ class Player:
     def __init__(self):
         pass
 
-# Load games from disk into memory
-def load_processed_data(processed_dir, n=None):
-    result = {}
-    i = 0
-    for filename in os.listdir(processed_dir):
+# Use this class to open a processed game's tables as memory maps the first time they're used
+# quarters holds the range of events and shots that belong to each quarter
+class GameTables:
+    def __init__(self, game_dir, quarters, mmap_mode='r'):
+        self.game_dir = game_dir
+        self.quarters = quarters
+        self.mmap_mode = mmap_mode
+        self._tables = {}
+
+    def __getitem__(self, name):
+        if name not in self._tables:
+            filename = os.path.join(self.game_dir, '{}.npy'.format(name))
+            self._tables[name] = np.load(filename, mmap_mode=self.mmap_mode)
+        return self._tables[name]
+
+    # Get a table computed from the others, computing and saving it only if it hasn't been saved
+    def derived(self, name, compute):
+        if name not in self._tables:
+            filename = os.path.join(self.game_dir, '{}.npy'.format(name))
+            if not os.path.exists(filename):
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+                # Write to a temporary file first, so a half-written table is never loaded
+                with open(filename + '.tmp', 'wb') as file:
+                    np.save(file, compute())
+                os.replace(filename + '.tmp', filename)
+            self._tables[name] = np.load(filename, mmap_mode=self.mmap_mode)
+        return self._tables[name]
+
+# Find the qualities of a game's shots with a registered model, in the order of its shots table
+# Each model's results are saved in the game's directory the first time, keyed by the model's
+#     name and version, so scoring the game again with the same model only reads them
+def score_shots(game, model=DEFAULT_SHOT_QUALITY_MODEL):
+    version, function = get_shot_quality_model(model)
+    if game.tables is None:
+        raise ValueError('Game {} was not saved as tables, so it can\'t be scored again'.format(
+            game.game_code))
+    shots = game.tables['shots']
+    if 'dribbles' not in shots.dtype.names:
+        raise ValueError('Game {} was saved without the inputs of the shot quality models; '
+                         'process it again'.format(game.game_code))
+    name = '{}.{}'.format(re.sub('[^A-Za-z0-9_-]+', '_', model), version)
+    return game.tables.derived(os.path.join(QUALITY_DIRNAME, name),
+                               lambda: np.asarray(function(shots), dtype='float'))
+
+# Find the qualities of the shots of many games with a registered model
+# Returns a dict from game code to the qualities of the game's shots
+def score_games(games, model=DEFAULT_SHOT_QUALITY_MODEL):
+    return {game_code: score_shots(game, model) for game_code, game in games.items()}
+
+# Open a game saved by processing.save_game
+# Only the small game file is read now; the tables are mapped when first used
+def load_game(game_dir, mmap_mode='r'):
+    with open(os.path.join(game_dir, GAME_FILENAME), 'rt') as file:
+        game_info = json.load(file)
+    game = Game(game_info['game code'])
+    game.teams = game_info['teams']
+    game.players = {int(player_id): player for player_id, player in game_info['players'].items()}
+    game.misc = game_info['misc']
+    quarters = {int(quarter_number): ranges
+                for quarter_number, ranges in game_info['quarters'].items()}
+    game.tables = GameTables(game_dir, quarters, mmap_mode)
+    game.quarters = None
+    return game
+
+# Rebuild the Quarter, Possession, Hold and Shot objects of a game from its tables
+def quarters_from_tables(game):
+    tables = game.tables
+    players = game.players
+    quarters = {1: Quarter(), 2: Quarter(), 3: Quarter(), 4: Quarter()}
+    possessions_table = tables['possessions']
+    has_inputs = 'dribbles' in tables['shots'].dtype.names
+    if game.quality_model is None:
+        qualities = tables['shots']['quality']
+    else:
+        qualities = score_shots(game, game.quality_model)
+
+    for quarter_number, ranges in tables.quarters.items():
+        quarter = quarters.setdefault(quarter_number, Quarter())
+        quarter.events = tables['events'][ranges['events'][0]:ranges['events'][1]]
+
+        # Rebuild the shots
+        quarter.shots = []
+        for i in range(*ranges['shots']):
+            row = tables['shots'][i]
+            shot = Shot(quarter.events, int(row['event index']), [float(row['x']), float(row['y'])],
+                        int(row['classification']), int(row['shooter id']), players)
+            shot.result = int(row['result'])
+            shot.points = int(row['points'])
+            shot.quality = qualities[i]
+            if has_inputs:
+                shot.dribbles = int(row['dribbles'])
+                shot.defender_dist = float(row['defender distance'])
+                shot.shot_dist = float(row['shot distance'])
+            quarter.shots.append(shot)
+
+        # Rebuild the possessions
+        quarter.possessions = []
+        for possession_number in np.flatnonzero(possessions_table['quarter'] == quarter_number):
+            row = possessions_table[possession_number]
+            event_indices = tables['possession events'][row['events start']:row['events stop']]
+            possession = Possession(game.game_code, quarter_number, int(row['team id']),
+                                    quarter.events, event_indices)
+            possession.thread = Thread(tables['holds'], row['holds start'], row['holds stop'], players)
+
+            possession.shots = [quarter.shots[j] for j in
+                                tables['possession shots'][row['shots start']:row['shots stop']]]
+            quarter.possessions.append(possession)
+    return quarters
+
+# Load one processed game, either a directory of tables or an older pickled game
+# With a quality_model, the shots of a game saved as tables get their quality from that model
+def load_game_file(path, mmap_mode='r', quality_model=None):
+    if os.path.isdir(path):
+        game = load_game(path, mmap_mode)
+        game.quality_model = quality_model
+        return game
+    return np.load(path, allow_pickle=True).item()
+
+# Load a game and build all of its objects, for prefetching in another thread or process
+def load_decoded_game(path, mmap_mode='r', quality_model=None):
+    game = load_game_file(path, mmap_mode, quality_model)
+    game.quarters
+    return game
+
+# Find the date a game was played from its code, e.g. 2016102505 was played on 2016-10-25
+def game_date(game_code):
+    return datetime.date(int(game_code[0:4]), int(game_code[4:6]), int(game_code[6:8]))
+
+# Use this class to load processed games only when they are first used
+# Behaves like a read-only dict from game code to Game, in game code order
+# At most cache_size games stay in memory, dropping the least recently used (None keeps them all)
+# Shots get their quality from quality_model, or from processing time if it's None
+class LazyGames(collections.abc.Mapping):
+    def __init__(self, paths, cache_size=256, quality_model=None):
+        self.paths = collections.OrderedDict(paths)
+        self.cache_size = cache_size
+        self.quality_model = quality_model
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, game_code):
+        with self._lock:
+            if game_code in self._cache:
+                self._cache.move_to_end(game_code)
+                return self._cache[game_code]
+        game = load_game_file(self.paths[game_code], quality_model=self.quality_model)
+        self._remember(game_code, game)
+        return game
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _remember(self, game_code, game):
+        with self._lock:
+            self._cache[game_code] = game
+            self._cache.move_to_end(game_code)
+            while self.cache_size is not None and len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # Load and build games ahead of time, using a pool of threads or processes
+    # Only as many games as the cache holds are kept
+    def prefetch(self, game_codes=None, workers=4, processes=False):
+        if game_codes is None:
+            game_codes = list(self.paths)
+        if self.cache_size is not None:
+            game_codes = game_codes[:self.cache_size]
+        game_codes = [game_code for game_code in game_codes if game_code not in self._cache]
+        if processes:
+            # Games sent back from another process can't share its memory maps
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            mmap_mode = None
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            mmap_mode = 'r'
+        with executor:
+            futures = {executor.submit(load_decoded_game, self.paths[game_code], mmap_mode,
+                                       self.quality_model): game_code
+                       for game_code in game_codes}
+            for future in concurrent.futures.as_completed(futures):
+                self._remember(futures[future], future.result())
+
+# Check whether either team in a game matches one of the given names, cities or ids
+def game_has_team(path, teams):
+    if os.path.isdir(path):
+        with open(os.path.join(path, GAME_FILENAME), 'rt') as file:
+            game_teams = json.load(file)['teams']
+    else:
+        game_teams = np.load(path, allow_pickle=True).item().teams
+    for team in game_teams.values():
+        names = [team['name'], team['city'], str(team['id']),
+                 '{} {}'.format(team['city'], team['name'])]
+        if any(name in teams for name in names):
+            return True
+    return False
+
+# Find processed games on disk, and get a dict of them that loads each game when it is first used
+# Games can be chosen by game code (first and last, inclusive), by date (first_date and last_date,
+#     inclusive), and by team (names, cities or ids), before any game is loaded
+# n limits the number of games, counting only games that match
+# Use prefetch=True to load the games ahead of time in parallel
+# Use quality_model to score the shots with a registered shot quality model
+def load_processed_data(processed_dir, n=None, first=None, last=None, first_date=None,
+                        last_date=None, teams=None, cache_size=256, prefetch=False, workers=4,
+                        quality_model=None):
+    # Find every processed game, in order of game code
+    # A game saved as tables is used over an older pickle of the same game
+    game_paths = {}
+    for filename in sorted(os.listdir(processed_dir)):
         game_code = filename.split('.')[0]
-        if n and i >= n:
-            break
         if re.fullmatch('\d+', game_code) is None:
             continue
-        result[game_code] = np.load(os.path.join(processed_dir, filename)).item()
-        
-        i += 1
-    return result
\ No newline at end of file
+        path = os.path.join(processed_dir, filename)
+        if os.path.isdir(path):
+            if not os.path.exists(os.path.join(path, GAME_FILENAME)):
+                continue
+        elif os.path.isdir(game_paths.get(game_code, '')):
+            continue
+        game_paths[game_code] = path
+    paths = sorted(game_paths.items())
+
+    # Choose the requested games
+    if first is not None:
+        paths = [(game_code, path) for game_code, path in paths if int(game_code) >= int(first)]
+    if last is not None:
+        paths = [(game_code, path) for game_code, path in paths if int(game_code) <= int(last)]
+    if first_date is not None:
+        paths = [(game_code, path) for game_code, path in paths
+                 if game_date(game_code) >= first_date]
+    if last_date is not None:
+        paths = [(game_code, path) for game_code, path in paths
+                 if game_date(game_code) <= last_date]
+    if teams is not None:
+        teams = [str(team) for team in teams]
+        paths = [(game_code, path) for game_code, path in paths if game_has_team(path, teams)]
+    if n:
+        paths = paths[:n]
+
+    result = LazyGames(paths, cache_size=cache_size, quality_model=quality_model)
+    if prefetch:
+        result.prefetch(workers=workers)
+    return result
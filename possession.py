@@ -1,5 +1,6 @@
 import numpy as np
 import enum
+import collections.abc
 
 # Use this type to classify the type of action that a player might take
 class PlayTypes(enum.IntEnum):
@@ -22,11 +23,244 @@ class PlayTypes(enum.IntEnum):
     RECEIVE_PASS = 23
     SHOT_CLOCK_VIOLATION = 28
 
+# Use this type to store how a player's hold on the ball ended
+class HoldEndTypes(enum.IntEnum):
+    NONE = 0
+    PASS = 1
+    SHOT = 2
+    DRIBBLE = 3
+    FOUL = 4
+    SHOT_CLOCK_VIOLATION = 5
+    INTERCEPTED = 6
+    TURNOVER = 7
+    END_PERIOD = 8
+    UNKNOWN = 9
+
+# The names used for each end type in Hold.end_type
+HOLD_END_TYPE_NAMES = {
+    HoldEndTypes.NONE: None,
+    HoldEndTypes.PASS: 'pass',
+    HoldEndTypes.SHOT: 'shot',
+    HoldEndTypes.DRIBBLE: 'dribble',
+    HoldEndTypes.FOUL: 'foul',
+    HoldEndTypes.SHOT_CLOCK_VIOLATION: 'shot clock violation',
+    HoldEndTypes.INTERCEPTED: 'intercepted',
+    HoldEndTypes.TURNOVER: 'turnover',
+    HoldEndTypes.END_PERIOD: 'end period',
+    HoldEndTypes.UNKNOWN: 'unknown',
+}
+HOLD_END_TYPE_CODES = {name: code for code, name in HOLD_END_TYPE_NAMES.items()}
+
+# The columns of a table of holds, one row per hold
+# possession is the position of the hold's possession in the list it was made from
+HOLDS_STRUCTURE = [('possession', 'int32'), ('start shot clock', 'float'),
+                   ('duration', 'float'), ('end type', 'int8'), ('player id', 'int64')]
+
+# The event types that end a possession with a foul
+FOUL_TYPES = (PlayTypes.FOUL, PlayTypes.FREE_THROW_MADE, PlayTypes.FREE_THROW_MISSED)
+
+# The end type of a hold still going at the end of a possession, by the possession's last event type
+FINAL_END_TYPES = {
+    PlayTypes.SHOT_CLOCK_VIOLATION: HoldEndTypes.SHOT_CLOCK_VIOLATION,
+    PlayTypes.FOUL: HoldEndTypes.FOUL,
+    PlayTypes.FREE_THROW_MADE: HoldEndTypes.FOUL,
+    PlayTypes.FREE_THROW_MISSED: HoldEndTypes.FOUL,
+    PlayTypes.RECEIVE_PASS: HoldEndTypes.PASS,
+    PlayTypes.OFFENSIVE_REBOUND: HoldEndTypes.SHOT,
+    PlayTypes.DEFENSIVE_REBOUND: HoldEndTypes.SHOT,
+    PlayTypes.TURNOVER: HoldEndTypes.TURNOVER,
+    PlayTypes.END_PERIOD: HoldEndTypes.END_PERIOD,
+    PlayTypes.END_OF_GAME: HoldEndTypes.END_PERIOD,
+}
+
+# The states of the thread builder
+AWAITING_START, HOLDING, DRIBBLING, BETWEEN_PLAYERS, INTERCEPTED, DEAD_BALL = range(6)
+
+# Make the threads of many possessions at once, as Possession.make_thread does for one
+# event_indices lists the events of each possession, as indices into events
+# The events are read into plain lists once, and the holds are written into flat lists, rather
+#     than looking up every event in the structured array and making a Hold for every hold
+# Returns a table of holds with HOLDS_STRUCTURE, in possession order, and the offsets of each
+#     possession's holds in it
+def make_threads(events, event_indices, game_code=None, quarter=None):
+    lengths = [len(indices) for indices in event_indices]
+    offsets = np.zeros(len(event_indices) + 1, dtype='int')
+    all_indices = np.concatenate([np.asarray(indices, dtype='int') for indices in event_indices] +
+                                 [np.zeros(0, dtype='int')])
+    event_types = events['event type'][all_indices].tolist()
+    shot_clocks = events['shot clock'][all_indices].tolist()
+    player_ids = events['event player id'][all_indices].tolist()
+    
+    hold_possessions = []
+    hold_starts = []
+    hold_durations = []
+    hold_end_types = []
+    hold_players = []
+    
+    # Run the state machine of make_thread over every possession
+    stop = 0
+    for possession_number, length in enumerate(lengths):
+        start = stop
+        stop = start + length
+        state = AWAITING_START
+        first_hold = len(hold_starts)
+        for j in range(start, stop):
+            event_type = event_types[j]
+            shot_clock = shot_clocks[j]
+            if len(hold_starts) == first_hold:
+                hold_possessions.append(possession_number)
+                hold_starts.append(shot_clock)
+                hold_durations.append(np.nan)
+                hold_end_types.append(HoldEndTypes.NONE)
+                hold_players.append(player_ids[j])
+                state = HOLDING
+            elif hold_starts[-1] - shot_clock < 0 and shot_clock > 20:
+                hold_durations[-1] = hold_starts[-1] - shot_clock
+                hold_end_types[-1] = HoldEndTypes.INTERCEPTED
+                state = INTERCEPTED
+                break
+            
+            if event_type in FOUL_TYPES:
+                hold_durations[-1] = hold_starts[-1] - shot_clock
+                hold_end_types[-1] = HoldEndTypes.FOUL
+                state = DEAD_BALL
+                break
+            elif event_type == PlayTypes.SHOT_CLOCK_VIOLATION:
+                hold_durations[-1] = hold_starts[-1] - shot_clock
+                hold_end_types[-1] = HoldEndTypes.SHOT_CLOCK_VIOLATION
+                state = DEAD_BALL
+            
+            if state == HOLDING and event_type == PlayTypes.DRIBBLE:
+                hold_durations[-1] = hold_starts[-1] - shot_clock
+                hold_end_types[-1] = HoldEndTypes.DRIBBLE
+                state = DRIBBLING
+            elif state == DRIBBLING and event_type != PlayTypes.DRIBBLE:
+                hold_possessions.append(possession_number)
+                hold_starts.append(shot_clock)
+                hold_durations.append(np.nan)
+                hold_end_types.append(HoldEndTypes.NONE)
+                hold_players.append(player_ids[j])
+                state = HOLDING
+            
+            if state == BETWEEN_PLAYERS and \
+               (event_type == PlayTypes.RECEIVE_PASS or event_type == PlayTypes.OFFENSIVE_REBOUND):
+                hold_possessions.append(possession_number)
+                hold_starts.append(shot_clock)
+                hold_durations.append(np.nan)
+                hold_end_types.append(HoldEndTypes.NONE)
+                hold_players.append(player_ids[j])
+                state = HOLDING
+            elif state == HOLDING and event_type == PlayTypes.THROW_PASS:
+                hold_durations[-1] = hold_starts[-1] - shot_clock
+                hold_end_types[-1] = HoldEndTypes.PASS
+                state = BETWEEN_PLAYERS
+            elif state == HOLDING and \
+                 (event_type == PlayTypes.FIELD_GOAL_MADE or event_type == PlayTypes.FIELD_GOAL_MISSED):
+                hold_durations[-1] = hold_starts[-1] - shot_clock
+                hold_end_types[-1] = HoldEndTypes.SHOT
+                state = BETWEEN_PLAYERS
+        
+        # If someone was still holding the ball, wrap up
+        if state == HOLDING:
+            hold_durations[-1] = hold_starts[-1] - shot_clock
+            last_type = event_types[stop - 1]
+            hold_end_types[-1] = FINAL_END_TYPES.get(last_type, HoldEndTypes.UNKNOWN)
+            if hold_end_types[-1] == HoldEndTypes.UNKNOWN:
+                print("Unknown end type: {} (game {} quarter {} time {})".format(
+                    last_type,
+                    game_code,
+                    quarter,
+                    events['game clock'][all_indices[stop - 1]]))
+        offsets[possession_number + 1] = len(hold_starts)
+    
+    holds = np.zeros(len(hold_starts), dtype=HOLDS_STRUCTURE)
+    holds['possession'] = hold_possessions
+    holds['start shot clock'] = hold_starts
+    holds['duration'] = hold_durations
+    holds['end type'] = hold_end_types
+    holds['player id'] = hold_players
+    return holds, offsets
+
+# Set the slots of an object from a pickled state, either a dict or a (dict, slots) pair
+def set_slots_state(obj, state):
+    if isinstance(state, tuple):
+        state = dict(state[0] or {}, **state[1])
+    for name, value in state.items():
+        setattr(obj, name, value)
+
+# Use this class to read one possession's thread from a table of holds
+# Stores only where the possession's holds are in the quarter's table, and makes a Hold for
+#     each hold as it is used, so a stored thread costs a few bytes per hold
+class Thread(collections.abc.Sequence):
+    __slots__ = ('holds', 'start', 'stop', 'players')
+
+    def __init__(self, holds, start, stop, players):
+        self.holds = holds
+        self.start = int(start)
+        self.stop = int(stop)
+        self.players = players
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('hold index out of range')
+        _, start_shot_clock, duration, end_type, player_id = self.holds[self.start + index].tolist()
+        return Hold(start_shot_clock,
+                    None if player_id == -1 else player_id,
+                    None if np.isnan(duration) else duration,
+                    end_type,
+                    self.players)
+
+    def __setstate__(self, state):
+        set_slots_state(self, state)
+
+# Use this class to store a possession
+# events is the quarter's events, shared by its possessions, and event_indices are this
+#     possession's events in it
 class Possession:
-    def __init__(self, game_code, quarter, team_id):
+    __slots__ = ('game_code', 'quarter', 'team_id', 'events', 'event_indices', 'thread', 'shots',
+                 '_events_raw')
+
+    def __init__(self, game_code, quarter, team_id, events=None, event_indices=None):
         self.game_code = game_code
         self.quarter = quarter
         self.team_id = team_id
+        self.events = events
+        self.event_indices = event_indices
+        self.thread = None
+        self.shots = None
+        self._events_raw = None
+
+    # The events of the possession, a view into the quarter's events if they are contiguous
+    @property
+    def events_raw(self):
+        if self._events_raw is not None or self.events is None:
+            return self._events_raw
+        indices = self.event_indices
+        if len(indices) == 0:
+            return self.events[0:0]
+        if indices[-1] - indices[0] + 1 == len(indices):
+            return self.events[indices[0]:indices[-1] + 1]
+        return self.events[indices]
+
+    @events_raw.setter
+    def events_raw(self, events_raw):
+        self._events_raw = events_raw
+
+    # Possessions pickled before __slots__ stored events_raw directly
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        if isinstance(state, dict) and 'events_raw' in state:
+            state = dict(state)
+            state['_events_raw'] = state.pop('events_raw')
+        set_slots_state(self, state)
     
     # Read a possession to make it analyzable
     def make_thread(self, events, players, verbose=False):
@@ -38,17 +272,13 @@ class Possession:
             # Identify the player, and their position
             player_id = events[j]['event player id']
             shot_clock = events[j]['shot clock']
-            try:
-                player = players[player_id]
-            except KeyError:
-                player = None
             if verbose:
                 print("Event {} ({})".format(events[j]['event type'], events[j]['shot clock']))
             
             # If this is the start, add it to the thread regardless
             # If the shot clock hasn't changed, reset the possession because it was a timeout
             if len(self.thread) == 0:
-                new_hold = Hold(shot_clock, player)
+                new_hold = Hold(shot_clock, player_id, players=players)
                 self.thread = [new_hold]
                 state = 'player holding ball'
                 if verbose:
@@ -94,7 +324,7 @@ class Possession:
             # If the player stops dribbling, make a new hold
             elif state == 'player dribbling ball' and \
                  events[j]['event type'] != PlayTypes.DRIBBLE:
-                new_hold = Hold(shot_clock, player)
+                new_hold = Hold(shot_clock, player_id, players=players)
                 self.thread.append(new_hold)
                 state = 'player holding ball'
                 if verbose:
@@ -104,7 +334,7 @@ class Possession:
             if   state == 'ball between players' and \
                  (events[j]['event type'] == PlayTypes.RECEIVE_PASS or \
                   events[j]['event type'] == PlayTypes.OFFENSIVE_REBOUND):
-                new_hold = Hold(shot_clock, player)
+                new_hold = Hold(shot_clock, player_id, players=players)
                 self.thread.append(new_hold)
                 state = 'player holding ball'
                 if verbose:
@@ -157,9 +387,45 @@ class Possession:
                     events[-1]['game clock']))
 
 # Use this class to store a 'hold' by a player
-class Hold():
-    def __init__(self, start_shot_clock=None, player=None, duration=None, end_type=None):
+# The end type is stored as a HoldEndTypes code, and the player as an id into players, the dict
+#     of players shared by the whole game
+class Hold:
+    __slots__ = ('start_shot_clock', 'player_id', 'duration', 'end_type_code', 'players')
+
+    def __init__(self, start_shot_clock=None, player_id=None, duration=None, end_type=None,
+                 players=None):
         self.start_shot_clock = start_shot_clock
-        self.player = player
+        self.player_id = player_id
         self.duration = duration
-        self.end_type = end_type
\ No newline at end of file
+        self.end_type = end_type
+        self.players = players
+
+    # The name of the end type, e.g. 'pass', or None if the hold hasn't ended
+    @property
+    def end_type(self):
+        return HOLD_END_TYPE_NAMES[self.end_type_code]
+
+    @end_type.setter
+    def end_type(self, end_type):
+        if end_type is None or isinstance(end_type, str):
+            self.end_type_code = HOLD_END_TYPE_CODES[end_type]
+        else:
+            self.end_type_code = HoldEndTypes(end_type)
+
+    # The players file row of the player holding the ball
+    @property
+    def player(self):
+        if self.players is None:
+            return None
+        return self.players.get(self.player_id)
+
+    # Holds pickled before __slots__ stored their end type name and player row
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        if isinstance(state, dict) and 'end_type' in state:
+            state = dict(state)
+            state['end_type_code'] = HOLD_END_TYPE_CODES[state.pop('end_type')]
+            state.setdefault('player_id', None)
+            state['players'] = {state['player_id']: state.pop('player')}
+        set_slots_state(self, state)
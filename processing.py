@@ -0,0 +1,696 @@
+import numpy as np
+import xml.etree.ElementTree as ElementTree
+import os
+import json
+import shutil
+from shot import Shot, classify_shots, calculate_shot_qualities
+from game import Game, Quarter, EVENTS_STRUCTURE, POSSESSIONS_STRUCTURE, SHOTS_STRUCTURE, \
+    TABLE_NAMES, GAME_FILENAME, GAME_FORMAT_VERSION, QUALITY_DIRNAME
+from possession import Possession, PlayTypes, make_threads, Thread, HOLD_END_TYPE_CODES, \
+    HOLDS_STRUCTURE
+from roster import get_roster, strip_accents
+from profiling import GameProfile
+
+# Read a single game's XML files into a Game
+# Give a GameProfile to time each stage and count what the game produced
+# The documents are read into their tables before any reader runs, so parsing is timed in the
+#     parse stage whether or not they are streamed
+def process_game(secondspectrum_dir, game_code, stream=False, roster=None, profile=None):
+    game = Game(game_code)
+    if profile is None:
+        profile = GameProfile(game_code)
+    
+    # Parse each of the game's documents once, and share them between the readers
+    with profile.stage('parse'):
+        documents = GameDocuments(secondspectrum_dir, game_code, stream=stream)
+    
+    # Get the player data for this game
+    with profile.stage('players'):
+        players_data = read_player_data(documents, roster)
+    game.players = players_data
+    profile.count('players', len(players_data))
+    
+    # Get the teams data for this game
+    with profile.stage('teams'):
+        teams_data = read_teams_data(documents)
+    game.teams = teams_data
+    
+    for quarter in range(1,5):
+        game.quarters[quarter] = Quarter()
+        
+        # Get the events data for this quarter
+        try:
+            with profile.stage('events'):
+                events_data = read_pbp_data(
+                    documents,
+                    quarter,
+                    teams_data,
+                    players_data)
+        except StopIteration:
+            continue
+        game.quarters[quarter].events = events_data
+        profile.count('events', len(events_data))
+        
+        # Get the shots data for this quarter
+        with profile.stage('shots'):
+            shots_data = read_shots(
+                documents,
+                quarter,
+                players_data,
+                events_data)
+        game.quarters[quarter].shots = shots_data
+        profile.count('shots', len(shots_data))
+        
+        # Get the possessions data for this quarter
+        with profile.stage('possessions'):
+            possessions_data = read_possessions_data(
+                documents,
+                quarter,
+                players_data,
+                events_data,
+                shots_data)
+        game.quarters[quarter].possessions = possessions_data
+        profile.count('possessions', len(possessions_data))
+    
+    return game
+
+# Stream the records of an XML document without building the whole tree
+# A record is any child of an element whose tag path is in parent_paths
+# Yields (parent element, record element) pairs, and drops everything that has been consumed
+def iterparse_records(filename, parent_paths):
+    tags = []
+    elements = []
+    record_depth = None
+    for event, elem in ElementTree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            if record_depth is None and tuple(tags) in parent_paths:
+                record_depth = len(tags)
+            tags.append(elem.tag)
+            elements.append(elem)
+            continue
+        
+        tags.pop()
+        elements.pop()
+        # Keep the children of a record until the record itself is complete
+        if record_depth is not None and len(tags) > record_depth:
+            continue
+        if len(tags) == record_depth:
+            yield elements[-1], elem
+            record_depth = None
+        # The finished element is always the last child of its parent, so drop it
+        if elements:
+            del elements[-1][-1]
+
+# The columns kept for every moment of the sequence play-by-play
+MOMENTS_STRUCTURE = [('game clock', 'float'), ('shot clock', 'float'),
+                     ('event player id', 'int'), ('event type', 'int')]
+
+# The columns kept for every possession of the box document, with times in seconds
+POSSESSION_TIMES_STRUCTURE = [('team id', 'int64'), ('time start', 'float'), ('time end', 'float')]
+
+# The columns kept for every shot of the box document's shot logs
+# quarter is 0 when the shot log doesn't say, and a missing position or distance is NaN or 10000
+SHOT_LOG_STRUCTURE = [('game clock', 'float'), ('quarter', 'int'), ('dribbles', 'int'),
+                      ('defender distance', 'float'), ('x', 'float'), ('y', 'float'),
+                      ('shot distance', 'float'), ('result', 'int'), ('points', 'int')]
+
+# Use this class to collect rows into a structured array as they are read, without knowing how
+#     many there will be
+# The array doubles in size whenever it is full
+class TableBuilder:
+    def __init__(self, structure, capacity=256):
+        self.table = np.zeros(capacity, dtype=structure)
+        self.size = 0
+    
+    def append(self, row):
+        if self.size == len(self.table):
+            self.table = np.concatenate([self.table, np.zeros_like(self.table)])
+        self.table[self.size] = row
+        self.size += 1
+    
+    # Get the rows that were added, without the unused space
+    def finish(self):
+        return self.table[:self.size].copy()
+
+# Convert a minutes:seconds time to seconds
+def _clock_seconds(clock):
+    minutes, seconds = clock.split(':')
+    return float(minutes)*60 + float(seconds)
+
+# Read the attributes of a moment into a row of MOMENTS_STRUCTURE
+def _moment_row(moment):
+    shot_clock = float(moment['shot-clock']) if len(moment['shot-clock']) > 0 else 0
+    return (float(moment['game-clock']), shot_clock, int(moment['global-player-id']),
+            int(moment['event-id']))
+
+# Read the attributes of a possession into a row of POSSESSION_TIMES_STRUCTURE
+def _possession_row(possession):
+    return (int(possession['team-global-id']), _clock_seconds(possession['time-start']),
+            _clock_seconds(possession['time-end']))
+
+# Read the attributes of a shot and its closest defender into a row of SHOT_LOG_STRUCTURE
+def _shot_log_row(shot, closest_defender):
+    x, y = np.nan, np.nan
+    if len(shot['x-coordinate']) > 0 and len(shot['y-coordinate']) > 0:
+        x, y = float(shot['x-coordinate']), float(shot['y-coordinate'])
+    return (_clock_seconds(shot['game-clock']),
+            int(shot.get('quarter', 0) or 0),
+            int(shot['dribbles']),
+            float(closest_defender['defender-distance']) if closest_defender is not None else np.nan,
+            x, y,
+            float(shot['shot-distance']) if len(shot['shot-distance']) else 10000.0,
+            1 if shot['result'] == 'made' else 0,
+            int(shot['points-type']))
+
+# Check whether a play is a field goal attempt, and return its quarter if it is, or None
+def _shot_play_quarter(play):
+    quarter = int(play['quarter'])
+    event_id = int(play['event-id'])
+    if event_id != PlayTypes.FIELD_GOAL_MADE and event_id != PlayTypes.FIELD_GOAL_MISSED:
+        return None
+    return quarter
+
+# Stream (sequence-pbp element, attributes) for every moment in a sequence play-by-play document
+def iter_moments(filename):
+    parent_path = ('sports-statistics', 'sports-boxscores', 'nba-boxscores', 'nba-boxscore',
+                   'sequence-pbp')
+    for sequence_pbp, moment in iterparse_records(filename, {parent_path}):
+        yield sequence_pbp, moment.attrib
+
+# Stream the attributes of every play in a pbp document
+def iter_plays(filename):
+    parent_path = ('sports-statistics', 'sports-scores', 'nba-scores', 'nba-playbyplay')
+    for _, play in iterparse_records(filename, {parent_path}):
+        if play.tag == 'play':
+            yield play.attrib
+
+# Stream the shot logs and the possessions of a box document, reading it only once
+# Yields (shot-log element, (shot attributes, closest defender attributes)) for every shot-log
+#     entry, and (quarter element, attributes) for every possession
+def iter_box_records(filename):
+    box_path = ('sports-statistics', 'sports-boxscores', 'nba-boxscores', 'nba-boxscore')
+    shot_log_path = box_path + ('players', 'player', 'shot-log')
+    quarter_path = box_path + ('possessions', 'quarter')
+    for parent, record in iterparse_records(filename, {shot_log_path, quarter_path}):
+        if parent.tag == 'shot-log':
+            if record.tag == 'shot':
+                yield parent, (record.attrib, next((c.attrib for c in record
+                                                    if c.tag == 'closest-defender'), None))
+        elif record.tag == 'possession':
+            yield parent, record.attrib
+
+# Collect records that come in blocks, like the moments of a period, into a table per block key
+# Only the first block with each key is kept, and later blocks with the same key are skipped
+# Takes (block element, key, row) for every record, and returns {key: table}
+def _collect_blocks(records, structure):
+    builders = {}
+    block = None
+    skip = False
+    for element, key, row in records:
+        if element is not block:
+            block = element
+            skip = key in builders
+            if not skip:
+                builders[key] = TableBuilder(structure)
+        if not skip:
+            builders[key].append(row)
+    return {key: builder.finish() for key, builder in builders.items()}
+
+# Use this class to parse each of a game's XML documents exactly once
+# Only what the readers need is kept, in compact tables: the moments of every period, the shot
+#     log, the possession times of every quarter, and the field goal plays of every quarter
+# With stream=True the large documents are read with iterparse, and each record goes straight into
+#     the tables, so neither the tree nor the records' attributes are ever held in memory
+class GameDocuments:
+    def __init__(self, dirname, game_code, stream=False):
+        self.game_code = game_code
+        self._shot_log_index = None
+        
+        # Read the oncourt document, which is small enough to always parse whole
+        oncourt_filename = 'NBA_FINAL_ONCOURT${}.XML'.format(game_code)
+        document = ElementTree.parse(os.path.join(dirname, oncourt_filename))
+        sports_statistics = document.getroot()
+        sports_oncourt = next(c for c in sports_statistics if c.tag == 'sports-oncourt')
+        nba_oncourt = next(c for c in sports_oncourt if c.tag == 'nba-oncourt')
+        self.oncourt_players = next(c for c in nba_oncourt if c.tag == 'nba-oncourt-players')
+        
+        sequence_path = os.path.join(
+            dirname, 'NBA_FINAL_SEQUENCE_PBP_OPTICAL${}.XML'.format(game_code))
+        box_path = os.path.join(dirname, 'NBA_FINALBOX_OPTICAL${}.XML'.format(game_code))
+        pbp_path = os.path.join(dirname, 'NBA_FINALPBP_EXP${}.XML'.format(game_code))
+        if stream:
+            self._stream_documents(sequence_path, box_path, pbp_path)
+        else:
+            self._parse_documents(sequence_path, box_path, pbp_path)
+    
+    def _parse_documents(self, sequence_path, box_path, pbp_path):
+        # Read the sequence play-by-play document, and keep the moments of every period
+        nba_boxscore = self._find_nba_boxscore(ElementTree.parse(sequence_path))
+        self.sequence_pbp = _collect_blocks(
+            ((c, c.attrib['period'], _moment_row(moment.attrib))
+             for c in nba_boxscore if c.tag == 'sequence-pbp' for moment in c),
+            MOMENTS_STRUCTURE)
+        for c in nba_boxscore:
+            if c.tag == 'sequence-pbp':
+                self.sequence_pbp.setdefault(c.attrib['period'], np.zeros(0, MOMENTS_STRUCTURE))
+        
+        # Read the box document, and keep the shot logs and the possessions of every quarter
+        nba_boxscore = self._find_nba_boxscore(ElementTree.parse(box_path))
+        shot_log = TableBuilder(SHOT_LOG_STRUCTURE)
+        for players_team in [c for c in nba_boxscore if c.tag == 'players']:
+            for player in [c for c in players_team if c.tag == 'player']:
+                try:
+                    player_shot_log = next(c for c in player if c.tag == 'shot-log')
+                except StopIteration:
+                    continue
+                for shot in [c for c in player_shot_log if c.tag == 'shot']:
+                    closest_defender = next((c.attrib for c in shot if c.tag == 'closest-defender'),
+                                            None)
+                    shot_log.append(_shot_log_row(shot.attrib, closest_defender))
+        self.shot_log = shot_log.finish()
+        possessions = next((c for c in nba_boxscore if c.tag == 'possessions'), [])
+        self.possessions = _collect_blocks(
+            ((c, int(c.attrib['number']), _possession_row(possession.attrib))
+             for c in possessions if c.tag == 'quarter'
+             for possession in c if possession.tag == 'possession'),
+            POSSESSION_TIMES_STRUCTURE)
+        for c in possessions:
+            if c.tag == 'quarter':
+                self.possessions.setdefault(int(c.attrib['number']),
+                                            np.zeros(0, POSSESSION_TIMES_STRUCTURE))
+        
+        # Read the pbp document, and keep its field goal plays
+        sports_statistics = ElementTree.parse(pbp_path).getroot()
+        sports_scores = next(c for c in sports_statistics if c.tag == 'sports-scores')
+        nba_scores = next(c for c in sports_scores if c.tag == 'nba-scores')
+        nba_pbp = next(c for c in nba_scores if c.tag == 'nba-playbyplay')
+        self.shot_plays = {}
+        for c in nba_pbp:
+            if c.tag == 'play':
+                self._add_play(c.attrib)
+    
+    def _stream_documents(self, sequence_path, box_path, pbp_path):
+        self.sequence_pbp = _collect_blocks(
+            ((sequence_pbp, sequence_pbp.attrib['period'], _moment_row(moment))
+             for sequence_pbp, moment in iter_moments(sequence_path)),
+            MOMENTS_STRUCTURE)
+        
+        # The shots go into the shot log as the possessions are collected, in the same pass
+        shot_log = TableBuilder(SHOT_LOG_STRUCTURE)
+        def possession_records():
+            for parent, record in iter_box_records(box_path):
+                if parent.tag == 'shot-log':
+                    shot_log.append(_shot_log_row(*record))
+                else:
+                    yield parent, int(parent.attrib['number']), _possession_row(record)
+        self.possessions = _collect_blocks(possession_records(), POSSESSION_TIMES_STRUCTURE)
+        self.shot_log = shot_log.finish()
+        
+        self.shot_plays = {}
+        for play in iter_plays(pbp_path):
+            self._add_play(play)
+    
+    # Keep a play if it's a field goal attempt
+    def _add_play(self, play):
+        quarter = _shot_play_quarter(play)
+        if quarter is not None:
+            self.shot_plays.setdefault(quarter, []).append(dict(play))
+    
+    @staticmethod
+    def _find_nba_boxscore(document):
+        sports_statistics = document.getroot()
+        sports_boxscores = next(c for c in sports_statistics if c.tag == 'sports-boxscores')
+        nba_boxscores = next(c for c in sports_boxscores if c.tag == 'nba-boxscores')
+        return next(c for c in nba_boxscores if c.tag == 'nba-boxscore')
+    
+    # Get the moments of a period, raising StopIteration if the period wasn't recorded
+    def moments(self, quarter):
+        try:
+            return self.sequence_pbp['{}'.format(quarter)]
+        except KeyError:
+            raise StopIteration
+    
+    # Get the shot log as sorted arrays, building them the first time they're needed
+    def shot_log_index(self):
+        if self._shot_log_index is None:
+            self._shot_log_index = ShotLogIndex(self.shot_log)
+        return self._shot_log_index
+    
+    # Get the possession times of a quarter, raising StopIteration if the quarter wasn't recorded
+    def quarter_possessions(self, quarter):
+        try:
+            return self.possessions[quarter]
+        except KeyError:
+            raise StopIteration
+    
+    # Get the attributes of the field goal plays of a quarter
+    def quarter_shot_plays(self, quarter):
+        return self.shot_plays.get(quarter, [])
+
+def read_pbp_data(documents, quarter, teams_data, players_data):
+    # Find the moments of this quarter
+    moments = documents.moments(quarter)
+    
+    # Compile all the data into a numpy table
+    events_result_structure = [('shot clock', 'float'), ('game clock', 'float'),
+                               ('event player id', 'int'), ('event team id', 'int'),
+                               ('event type', 'int')]
+    events_result = np.zeros(len(moments), dtype=events_result_structure)
+    for name in ['game clock', 'shot clock', 'event player id', 'event type']:
+        events_result[name] = moments[name]
+    
+    # Find the team of every event's player
+    for event_player in np.unique(moments['event player id']).tolist():
+        if event_player in players_data:
+            events_result['event team id'][moments['event player id'] == event_player] = \
+                players_data[event_player]['team id']
+    for event_player in moments['event player id'].tolist():
+        if event_player not in players_data:
+            print("Unidentified player {}".format(event_player))
+    
+    return events_result
+
+def read_player_data(documents, roster=None):
+    players_result = {}
+    
+    # Use the oncourt document
+    nba_oncourt_players = documents.oncourt_players
+    
+    visiting_team = next(c for c in nba_oncourt_players if c.tag == 'visiting-team')
+    away_id = next(c for c in visiting_team if c.tag == 'team-code').attrib['global-id']
+    
+    home_team = next(c for c in nba_oncourt_players if c.tag == 'home-team')
+    home_id = next(c for c in visiting_team if c.tag == 'team-code').attrib['global-id']
+
+    # Find the name of the players in this game
+    temp_players = []
+    for oncourt in [c for c in nba_oncourt_players if c.tag == 'oncourt']:
+        teams = [(next(c for c in oncourt if c.tag == 'visiting-team-players'), away_id),
+                 (next(c for c in oncourt if c.tag == 'home-team-players'), home_id)]
+        for team, team_id in teams:
+            for player in team:
+                name = strip_accents(player.attrib['display-name'].replace('.', ''))
+                player_id = int(player.attrib['global-id'])
+                temp_players.append((name, player_id, team_id))
+
+    # Reorganize the players data to fit into the data from the players file
+    # Each game gets its own copy of the rows it uses
+    if roster is None:
+        roster = get_roster()
+    game_rows = {}
+    for name, player_id, team_id in temp_players:
+        best_score_index = roster.resolve(player_id, name)
+        if best_score_index not in game_rows:
+            game_rows[best_score_index] = dict(roster.rows[best_score_index])
+        players_result[player_id] = game_rows[best_score_index]
+        players_result[player_id]['team id'] = team_id
+    
+    return players_result
+
+def read_possessions_data(documents, quarter, players_data, events_data, shots_data):
+    # Find the possessions of this quarter
+    game_code = documents.game_code
+    quarter_possessions = documents.quarter_possessions(quarter)
+    
+    # The start and end time of every possession
+    start_times = quarter_possessions['time start']
+    end_times = quarter_possessions['time end']
+    
+    # Find the events strictly between the start and end of each possession
+    # The game clock counts down, so normally each possession is a contiguous run of events
+    game_clock = events_data['game clock']
+    contiguous = np.all(np.diff(game_clock) <= 0)
+    if contiguous:
+        firsts = np.searchsorted(-game_clock, -start_times, side='right')
+        lasts = np.maximum(np.searchsorted(-game_clock, -end_times, side='left'), firsts)
+        event_indices = [np.arange(first, last) for first, last in zip(firsts, lasts)]
+    else:
+        print("Game clock out of order in game {} quarter {}".format(game_code, quarter))
+        event_indices = [np.flatnonzero(np.logical_and(start_time > game_clock,
+                                                       game_clock > end_time))
+                         for start_time, end_time in zip(start_times, end_times)]
+    
+    # Order the shots by their event, so each possession's shots can be found by searching
+    shot_events = np.array([shot.event_index for shot in shots_data], dtype='int')
+    shot_order = np.argsort(shot_events, kind='stable')
+    sorted_shot_events = shot_events[shot_order]
+    
+    # Make the threads of every possession at once
+    holds, holds_offsets = make_threads(events_data, event_indices, game_code, quarter)
+    
+    possessions_result = []
+    
+    # For each possession, make a processeable thread for it, and record all the shots
+    for i, team_id in enumerate(quarter_possessions['team id'].tolist()):
+        new_possession = Possession(game_code, quarter, team_id, events_data, event_indices[i])
+        
+        if contiguous:
+            shot_first, shot_last = np.searchsorted(sorted_shot_events, [firsts[i], lasts[i]])
+            possession_shots = np.sort(shot_order[shot_first:shot_last])
+        else:
+            possession_shots = np.flatnonzero(np.isin(shot_events, event_indices[i]))
+        new_possession.thread = Thread(holds, holds_offsets[i], holds_offsets[i + 1], players_data)
+        
+        new_possession.shots = [shots_data[j] for j in possession_shots]
+        
+        possessions_result.append(new_possession)
+    return possessions_result
+
+def read_teams_data(documents):
+    teams_result = {}
+    
+    # Use the oncourt document
+    nba_oncourt_players = documents.oncourt_players
+
+    # Find the home team
+    home_team_tag = next(c for c in nba_oncourt_players if c.tag == 'home-team')
+    home_team_city = next(c for c in home_team_tag if c.tag == 'team-city').attrib['city']
+    home_team_name = next(c for c in home_team_tag if c.tag == 'team-name').attrib['name']
+    home_team_id = next(c for c in home_team_tag if c.tag == 'team-code').attrib['global-id']
+    teams_result['home'] = {'name': home_team_name,
+                            'city': home_team_city,
+                            'id': home_team_id}
+
+    # Find the away team
+    away_team_tag = next(c for c in nba_oncourt_players if c.tag == 'visiting-team')
+    away_team_city = next(c for c in away_team_tag if c.tag == 'team-city').attrib['city']
+    away_team_name = next(c for c in away_team_tag if c.tag == 'team-name').attrib['name']
+    away_team_id = next(c for c in away_team_tag if c.tag == 'team-code').attrib['global-id']
+    teams_result['away'] = {'name': away_team_name,
+                            'city': away_team_city,
+                            'id': away_team_id}
+    
+    return teams_result
+
+# Use this class to find the shot log entry closest in time to a play
+# The shot log is parsed once per game into arrays sorted by game clock, one set per quarter
+# If the shot log doesn't say which quarter a shot was in, every quarter searches the whole game
+class ShotLogIndex:
+    def __init__(self, shot_log):
+        n = len(shot_log)
+        clock = shot_log['game clock']
+        quarter = shot_log['quarter']
+        self.dribbles = shot_log['dribbles']
+        self.defender_dist = shot_log['defender distance']
+        self.position = np.stack([shot_log['x'], shot_log['y']], axis=1)
+        self.shot_dist = shot_log['shot distance']
+        self.result = shot_log['result']
+        self.points = shot_log['points']
+        
+        # Sort each quarter's shots by clock, breaking ties by their order in the file
+        self.by_quarter = {}
+        self.has_quarters = n > 0 and np.all(quarter > 0)
+        for q in (np.unique(quarter) if self.has_quarters else [0]):
+            indices = np.flatnonzero(quarter == q) if self.has_quarters else np.arange(n)
+            order = indices[np.lexsort((indices, clock[indices]))]
+            self.by_quarter[q] = (clock[order], order)
+    
+    # Find the index of the closest shot for each time, or -1 if there are none
+    # Of two equally close shots, the one earlier in the file wins
+    def nearest(self, quarter, times):
+        times = np.asarray(times, dtype='float')
+        sorted_clock, order = self.by_quarter.get(quarter if self.has_quarters else 0,
+                                                  (np.zeros(0), np.zeros(0, dtype='int')))
+        if len(sorted_clock) == 0:
+            return np.full(len(times), -1)
+        
+        # The candidates are the first shot at or after the time, and the first shot of the run before it
+        after = np.searchsorted(sorted_clock, times, side='left')
+        before = np.searchsorted(sorted_clock, sorted_clock[np.maximum(after - 1, 0)], side='left')
+        after_valid = after < len(sorted_clock)
+        before_valid = after > 0
+        after = np.minimum(after, len(sorted_clock) - 1)
+        
+        after_dist = np.where(after_valid, np.abs(times - sorted_clock[after]), np.inf)
+        before_dist = np.where(before_valid, np.abs(times - sorted_clock[before]), np.inf)
+        use_before = (before_dist < after_dist) | \
+                     ((before_dist == after_dist) & (order[before] < order[after]))
+        return np.where(use_before, order[before], order[after])
+
+# Find the index of the closest event for each time, given the game clock of a quarter's events
+# The game clock only runs down, so the candidates are the first event at or below the time, and
+#     the first event of the run above it
+# Of two equally close events, the earlier one wins
+def _nearest_events(game_clock, times):
+    times = np.asarray(times, dtype='float')
+    if len(times) == 0:
+        return np.zeros(0, dtype='int')
+    clock = -np.asarray(game_clock, dtype='float')
+    after = np.searchsorted(clock, -times, side='left')
+    before = np.searchsorted(clock, clock[np.maximum(after - 1, 0)], side='left')
+    after_valid = after < len(clock)
+    before_valid = after > 0
+    after = np.minimum(after, len(clock) - 1)
+    
+    after_dist = np.where(after_valid, np.abs(times + clock[after]), np.inf)
+    before_dist = np.where(before_valid, np.abs(times + clock[before]), np.inf)
+    return np.where(before_dist <= after_dist, before, after)
+
+def read_shots(documents, quarter, players_data, events_data):
+    # Compile all the data
+    shots_result = []
+    
+    # Find the shots of the requested quarter
+    plays = documents.quarter_shot_plays(quarter)
+    
+    # Compute the times, link them to the events, and to the closest shot in the shots file
+    times = np.array([float(play['time-minutes'])*60 + float(play['time-seconds']) for play in plays])
+    event_indices = _nearest_events(events_data['game clock'], times)
+    shot_log = documents.shot_log_index()
+    shot_indices = shot_log.nearest(quarter, times)
+    
+    # Skip the plays with no shot in the shot log
+    found = []
+    for play, event_index, shot_index in zip(plays, event_indices, shot_indices):
+        if shot_index < 0:
+            print("Can't find shot for event at time {}".format(events_data['game clock']))
+            continue
+        found.append((play, int(event_index), shot_index))
+    
+    # Classify the shots and compute their quality all at once
+    found_indices = np.array([shot_index for _, _, shot_index in found], dtype='int')
+    classifications = classify_shots([play['detail-description'] for play, _, _ in found])
+    qualities = calculate_shot_qualities(shot_log.dribbles[found_indices],
+                                         shot_log.defender_dist[found_indices],
+                                         shot_log.shot_dist[found_indices])
+    
+    for (play, event_index, shot_index), classification, quality in \
+            zip(found, classifications.tolist(), qualities):
+        position = [float(x) for x in shot_log.position[shot_index]]
+        
+        # Record the shot details
+        shooter_id = int(play['global-player-id-1'])
+        
+        # Every shooter must be one of the game's players
+        if shooter_id not in players_data:
+            raise KeyError(shooter_id)
+        new_shot = Shot(events_data, event_index, position, classification, shooter_id, players_data)
+        new_shot.result = int(shot_log.result[shot_index])
+        new_shot.points = int(shot_log.points[shot_index])
+        new_shot.quality = quality
+        new_shot.dribbles = int(shot_log.dribbles[shot_index])
+        new_shot.defender_dist = float(shot_log.defender_dist[shot_index])
+        new_shot.shot_dist = float(shot_log.shot_dist[shot_index])
+        
+        shots_result.append(new_shot)
+    return shots_result
+
+# Save a game as flat tables, with integer ids in place of the player dicts
+def save_game(game, game_dir):
+    os.makedirs(game_dir, exist_ok=True)
+    
+    # Remove the game file first, so a game that is only partly rewritten is never loaded
+    try:
+        os.remove(os.path.join(game_dir, GAME_FILENAME))
+    except FileNotFoundError:
+        pass
+    tables = {name: [] for name in TABLE_NAMES}
+    quarters = {}
+    events_offset = 0
+    shots_offset = 0
+    possession_events_offset = 0
+    possession_shots_offset = 0
+    
+    for quarter_number, quarter in sorted(game.quarters.items()):
+        if quarter.events is None:
+            continue
+        quarters[quarter_number] = {'events': [events_offset, events_offset + len(quarter.events)],
+                                    'shots': [shots_offset, shots_offset + len(quarter.shots)]}
+        events_offset += len(quarter.events)
+        shots_offset += len(quarter.shots)
+        tables['events'].append(np.asarray(quarter.events, dtype=EVENTS_STRUCTURE))
+    
+        # Record the shots, and where they are so possessions can refer to them
+        shot_indices = {}
+        for i, shot in enumerate(quarter.shots):
+            shot_indices[id(shot)] = i
+            tables['shots'].append((quarter_number, shot.event_index,
+                                    shot.position[0], shot.position[1], shot.classification,
+                                    shot.shooter_id, shot.result, shot.points, shot.quality,
+                                    -1 if shot.dribbles is None else shot.dribbles,
+                                    np.nan if shot.defender_dist is None else shot.defender_dist,
+                                    np.nan if shot.shot_dist is None else shot.shot_dist))
+    
+        # Record each possession with the ranges of its events, holds and shots
+        for possession in quarter.possessions:
+            possession_number = len(tables['possessions'])
+            events_start = possession_events_offset
+            possession_events_offset += len(possession.event_indices)
+            tables['possession events'].append(np.asarray(possession.event_indices, dtype='int32'))
+            holds_start = len(tables['holds'])
+            for hold in possession.thread:
+                tables['holds'].append((
+                    possession_number,
+                    hold.start_shot_clock,
+                    np.nan if hold.duration is None else hold.duration,
+                    HOLD_END_TYPE_CODES[hold.end_type],
+                    -1 if hold.player_id is None else hold.player_id))
+            shots_start = possession_shots_offset
+            possession_shots_offset += len(possession.shots)
+            tables['possession shots'].append(
+                np.array([shot_indices[id(shot)] for shot in possession.shots], dtype='int32'))
+            tables['possessions'].append((
+                quarter_number, possession.team_id,
+                events_start, events_start + len(possession.event_indices),
+                holds_start, len(tables['holds']),
+                shots_start, shots_start + len(possession.shots)))
+    
+    # Write every table, then the game file last, so its presence means the game is complete
+    arrays = {
+        'events': np.concatenate(tables['events']) if tables['events']
+                  else np.zeros(0, dtype=EVENTS_STRUCTURE),
+        'possessions': np.array(tables['possessions'], dtype=POSSESSIONS_STRUCTURE),
+        'possession events': np.concatenate(tables['possession events'] + [np.zeros(0, 'int32')]),
+        'holds': np.array(tables['holds'], dtype=HOLDS_STRUCTURE),
+        'shots': np.array(tables['shots'], dtype=SHOTS_STRUCTURE),
+        'possession shots': np.concatenate(tables['possession shots'] + [np.zeros(0, 'int32')]),
+    }
+    # Each table replaces the old one in a single step, so anyone who has the old one memory
+    #     mapped keeps reading it whole
+    for name, array in arrays.items():
+        filename = os.path.join(game_dir, '{}.npy'.format(name))
+        with open(filename + '.tmp', 'wb') as file:
+            np.save(file, array)
+        os.replace(filename + '.tmp', filename)
+    
+    # Qualities saved for the old shots no longer apply
+    shutil.rmtree(os.path.join(game_dir, QUALITY_DIRNAME), ignore_errors=True)
+    
+    game_info = {
+        'format': GAME_FORMAT_VERSION,
+        'game code': game.game_code,
+        'teams': game.teams,
+        'players': {str(player_id): player for player_id, player in game.players.items()},
+        'quarters': {str(quarter_number): ranges for quarter_number, ranges in quarters.items()},
+        'misc': game.misc,
+    }
+    with open(os.path.join(game_dir, GAME_FILENAME + '.tmp'), 'wt') as file:
+        json.dump(game_info, file)
+    os.replace(os.path.join(game_dir, GAME_FILENAME + '.tmp'),
+               os.path.join(game_dir, GAME_FILENAME))
+    
+    # A game pickled before the tables existed is now out of date, so it is never loaded instead
+    try:
+        os.remove(os.path.normpath(game_dir) + '.npy')
+    except FileNotFoundError:
+        pass
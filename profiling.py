@@ -0,0 +1,137 @@
+import cProfile
+import contextlib
+import json
+import os
+import sys
+import time
+import numpy as np
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, so peak memory isn't reported there
+    resource = None
+
+# Find the most memory this process has used so far, in megabytes, or None if it can't be found
+# With several workers, this is the peak of the worker that processed the game
+def peak_memory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS reports bytes
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak/1024
+
+# Use this class to time the stages of processing one game, and count what it produced
+# A stage can be entered several times, e.g. once per quarter, and its times are added up
+# Give a profile_dir to also run cProfile over every stage, saving '<game code> <stage>.prof'
+#     files there that can be read with pstats or snakeviz
+class GameProfile:
+    def __init__(self, game_code, profile_dir=None):
+        self.game_code = game_code
+        self.profile_dir = profile_dir
+        self.stages = {}
+        self.counts = {}
+        self.profilers = {}
+        self.start = time.perf_counter()
+
+    # Time everything inside a with block as part of a stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = self.profilers.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            if profiler is not None:
+                profiler.disable()
+            times = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            times['wall'] += wall
+            times['cpu'] += cpu
+
+    # Count some of the things the game produced, e.g. its events or shots
+    def count(self, name, number):
+        self.counts[name] = self.counts.get(name, 0) + number
+
+    # Make the record of the game, as it goes in the processing log
+    # Saves the cProfile stats of every stage, if they were collected
+    def record(self, error=None):
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, profiler in self.profilers.items():
+                profiler.dump_stats(os.path.join(self.profile_dir,
+                                                 '{} {}.prof'.format(self.game_code, name)))
+        return {'game': self.game_code,
+                'error': error,
+                'wall': time.perf_counter() - self.start,
+                'stages': self.stages,
+                'counts': self.counts,
+                'peak memory': peak_memory()}
+
+# Add records to a log with one JSON object per line
+def write_log_records(filename, records):
+    with open(filename, 'at') as file:
+        for record in records:
+            file.write(json.dumps(record, sort_keys=True) + '\n')
+
+# Read every record of a log with one JSON object per line
+def read_log_records(filename):
+    records = []
+    with open(filename, 'rt') as file:
+        for line in file:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+# Summarize the records of many games: the median and 95th percentile time of every stage,
+#     the total counts, and how many games were processed per second of elapsed time
+# Failed games are counted, but their times are left out
+def summarize_records(records, elapsed):
+    finished = [record for record in records if record.get('error') is None]
+    stage_names = []
+    for record in finished:
+        for name in record['stages']:
+            if name not in stage_names:
+                stage_names.append(name)
+
+    stages = {}
+    for name in stage_names:
+        wall = np.array([record['stages'].get(name, {'wall': 0.0})['wall'] for record in finished])
+        cpu = np.array([record['stages'].get(name, {'cpu': 0.0})['cpu'] for record in finished])
+        stages[name] = {'p50 wall': float(np.percentile(wall, 50)),
+                        'p95 wall': float(np.percentile(wall, 95)),
+                        'p50 cpu': float(np.percentile(cpu, 50)),
+                        'p95 cpu': float(np.percentile(cpu, 95)),
+                        'total wall': float(wall.sum())}
+    counts = {}
+    for record in finished:
+        for name, number in record['counts'].items():
+            counts[name] = counts.get(name, 0) + number
+    peaks = [record['peak memory'] for record in finished if record['peak memory'] is not None]
+    return {'games': len(finished),
+            'failed': len(records) - len(finished),
+            'elapsed': elapsed,
+            'games per second': len(finished)/elapsed if elapsed > 0 else float('nan'),
+            'stages': stages,
+            'counts': counts,
+            'peak memory': max(peaks) if peaks else None}
+
+# Print a summary made by summarize_records as a table
+def print_summary(summary):
+    print("{} games in {:.1f}s, {:.2f} games/s, {} failed".format(
+        summary['games'], summary['elapsed'], summary['games per second'], summary['failed']))
+    if summary['peak memory'] is not None:
+        print("Peak memory {:.0f}MB".format(summary['peak memory']))
+    print("{:<12} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        'stage', 'p50 wall', 'p95 wall', 'p50 cpu', 'p95 cpu', 'total'))
+    for name, times in summary['stages'].items():
+        print("{:<12} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.2f}".format(
+            name, times['p50 wall'], times['p95 wall'], times['p50 cpu'], times['p95 cpu'],
+            times['total wall']))
+    print(', '.join('{} {}'.format(number, name) for name, number in summary['counts'].items()))
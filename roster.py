@@ -0,0 +1,110 @@
+import csv
+import json
+import os
+import unicodedata
+
+# Remove accents from a string
+def strip_accents(s):
+    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+
+# Score how similar two names are, to deal with inexact matches
+def score_name_similarity(a, b):
+    a_split = a.split(' ')
+    b_split = b.split(' ')
+    result = 0
+    for word in a_split:
+        if word in b_split:
+            result += 1
+    return result
+
+# Use this class to match secondspectrum players to the rows of the players file
+# The file is read once, and every name is indexed by its words, so a match only
+#     looks at the rows that share a word with the name
+# Matches are remembered by global id, and can be saved so later runs skip matching entirely
+class Roster:
+    def __init__(self, players_filename='players.csv', ids_filename=None):
+        self.players_filename = players_filename
+        self.ids_filename = ids_filename
+
+        # Read every row of the players file
+        self.rows = []
+        with open(players_filename, 'rt') as csv_file:
+            csv_reader = csv.DictReader(csv_file)
+            for ordered_row in csv_reader:
+                self.rows.append(dict(ordered_row))
+
+        # Index the rows by the words in their names
+        self.rows_by_word = {}
+        for i, row in enumerate(self.rows):
+            for word in set(row['name'].split(' ')):
+                self.rows_by_word.setdefault(word, []).append(i)
+
+        # Map global ids to (display name, row index)
+        self.ids = {}
+        self.new_ids = {}
+        if ids_filename is not None and os.path.exists(ids_filename):
+            self.load(ids_filename)
+
+    # Find the index of the row whose name shares the most words with this name
+    # Ties go to the earlier row, and a name with no matching words gets the first row
+    def find(self, name):
+        scores = {}
+        for word in name.split(' '):
+            for i in self.rows_by_word.get(word, ()):
+                scores[i] = scores.get(i, 0) + 1
+        if len(scores) == 0:
+            print('{} not found'.format(name))
+            return 0
+        return min(scores, key=lambda i: (-scores[i], i))
+
+    # Find the row index for a player, matching the name only the first time the id is seen
+    def resolve(self, player_id, name):
+        try:
+            known_name, index = self.ids[player_id]
+            if known_name == name:
+                return index
+        except KeyError:
+            pass
+        index = self.find(name)
+        self.ids[player_id] = (name, index)
+        self.new_ids[player_id] = (name, index)
+        return index
+
+    # Hand over the ids matched since the last call, e.g. to send them back from a worker process
+    def take_new_ids(self):
+        new_ids = self.new_ids
+        self.new_ids = {}
+        return new_ids
+
+    # Add ids that were matched elsewhere
+    def update(self, ids):
+        for player_id, (name, index) in ids.items():
+            self.ids[player_id] = (name, index)
+            self.new_ids[player_id] = (name, index)
+
+    # Read saved matches, ignoring any that no longer point at the same row of the players file
+    def load(self, ids_filename):
+        with open(ids_filename, 'rt') as file:
+            saved = json.load(file)
+        for player_id, entry in saved.items():
+            index = entry['row']
+            if index < len(self.rows) and self.rows[index]['name'] == entry['row name']:
+                self.ids[int(player_id)] = (entry['name'], index)
+
+    # Save the matches, replacing the old file in a single step
+    def save(self, ids_filename=None):
+        ids_filename = ids_filename or self.ids_filename
+        saved = {str(player_id): {'name': name, 'row': index, 'row name': self.rows[index]['name']}
+                 for player_id, (name, index) in self.ids.items()}
+        with open(ids_filename + '.tmp', 'wt') as file:
+            json.dump(saved, file, indent=1, sort_keys=True)
+        os.replace(ids_filename + '.tmp', ids_filename)
+        self.new_ids = {}
+
+# Share one roster between all the games processed in this process
+_rosters = {}
+def get_roster(players_filename='players.csv', ids_filename=None):
+    key = (players_filename, ids_filename)
+    if key not in _rosters:
+        _rosters[key] = Roster(players_filename, ids_filename)
+    return _rosters[key]
@@ -0,0 +1,315 @@
+import numpy as np
+import os
+import json
+import game as game_module
+
+# The columns of the season's tables
+# possession is a row of the season's possessions table, and shots are listed in possession order
+SEASON_POSSESSIONS_STRUCTURE = [('game', 'int64'), ('quarter', 'int8'), ('team id', 'int64'),
+                                ('holds start', 'int64'), ('holds stop', 'int64'),
+                                ('shots start', 'int64'), ('shots stop', 'int64')]
+SEASON_HOLDS_STRUCTURE = [('game', 'int64'), ('quarter', 'int8'), ('possession', 'int64'),
+                          ('team id', 'int64'), ('start shot clock', 'float'), ('duration', 'float'),
+                          ('end type', 'int8'), ('player id', 'int64')]
+SEASON_SHOTS_STRUCTURE = [('game', 'int64'), ('quarter', 'int8'), ('possession', 'int64'),
+                          ('team id', 'int64')] + \
+                         [(name, dtype) for name, dtype in game_module.SHOTS_STRUCTURE
+                          if name != 'quarter']
+SEASON_TABLES = {'possessions': SEASON_POSSESSIONS_STRUCTURE,
+                 'holds': SEASON_HOLDS_STRUCTURE,
+                 'shots': SEASON_SHOTS_STRUCTURE}
+
+# The columns of each table with a sorted index, for finding rows without reading the whole column
+INDEXED_COLUMNS = {'possessions': ['game', 'quarter', 'team id'],
+                   'holds': ['game', 'quarter', 'team id', 'player id'],
+                   'shots': ['game', 'quarter', 'team id', 'shooter id']}
+
+# The file describing a season index, written last so its presence means the index is complete
+INDEX_FILENAME = 'index.json'
+INDEX_DIRNAME = 'season index'
+
+# The players file row of every player in the season, by id
+PLAYERS_FILENAME = 'players.json'
+
+# Make one game's rows of the season's tables
+# holds_offset and shots_offset are where the game's holds and shots start in the season's tables
+def game_season_rows(game, possessions_offset, holds_offset, shots_offset):
+    tables = game.tables
+    game_code = int(game.game_code)
+    possessions = tables['possessions']
+    game_holds = tables['holds']
+    game_shots = tables['shots']
+
+    # Possession shots are listed by their position in the quarter
+    quarter_shots_start = np.zeros(max(list(tables.quarters) + [0]) + 1, dtype='int64')
+    for quarter_number, ranges in tables.quarters.items():
+        quarter_shots_start[quarter_number] = ranges['shots'][0]
+    shots_count = possessions['shots stop'] - possessions['shots start']
+    possession_shots = np.asarray(tables['possession shots'], dtype='int64') + \
+                       np.repeat(quarter_shots_start[possessions['quarter']], shots_count)
+
+    season_possessions = np.zeros(len(possessions), dtype=SEASON_POSSESSIONS_STRUCTURE)
+    season_possessions['game'] = game_code
+    season_possessions['quarter'] = possessions['quarter']
+    season_possessions['team id'] = possessions['team id']
+    season_possessions['holds start'] = possessions['holds start'] + holds_offset
+    season_possessions['holds stop'] = possessions['holds stop'] + holds_offset
+    season_possessions['shots start'] = possessions['shots start'] + shots_offset
+    season_possessions['shots stop'] = possessions['shots stop'] + shots_offset
+
+    holds = np.zeros(len(game_holds), dtype=SEASON_HOLDS_STRUCTURE)
+    holds['game'] = game_code
+    holds['possession'] = game_holds['possession'] + possessions_offset
+    holds['quarter'] = possessions['quarter'][game_holds['possession']]
+    holds['team id'] = possessions['team id'][game_holds['possession']]
+    for name in ['start shot clock', 'duration', 'end type', 'player id']:
+        holds[name] = game_holds[name]
+
+    # Shots go in possession order; a shot in no possession goes after them, with possession -1
+    shot_possessions = np.repeat(np.arange(len(possessions)), shots_count)
+    in_possession = np.zeros(len(game_shots), dtype='bool')
+    in_possession[possession_shots] = True
+    order = np.concatenate([possession_shots, np.flatnonzero(~in_possession)])
+    shots = np.zeros(len(order), dtype=SEASON_SHOTS_STRUCTURE)
+    shots['game'] = game_code
+    shots['possession'] = np.concatenate([shot_possessions + possessions_offset,
+                                          np.full(len(order) - len(possession_shots), -1)])
+    shots['team id'] = np.concatenate([possessions['team id'][shot_possessions],
+                                       np.full(len(order) - len(possession_shots), -1)])
+    for name in game_shots.dtype.names:
+        if name in shots.dtype.names:
+            shots[name] = game_shots[name][order]
+    return season_possessions, holds, shots
+
+# Read the record of which games a season index was built from, or None if there isn't one
+def read_index_info(index_dir):
+    try:
+        with open(os.path.join(index_dir, INDEX_FILENAME), 'rt') as file:
+            index_info = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if index_info.get('format') != game_module.GAME_FORMAT_VERSION:
+        return None
+    return index_info
+
+# Find when every processed game saved as tables was last saved
+def game_times(games):
+    times = {}
+    for game_code, path in games.paths.items():
+        if os.path.isdir(path):
+            times[game_code] = os.path.getmtime(os.path.join(path, game_module.GAME_FILENAME))
+        else:
+            print('Game {} was not saved as tables, so it is not in the season index'.format(
+                game_code))
+    return times
+
+# Save a table without disturbing anyone who has the old one memory mapped
+def _save_table(index_dir, name, table):
+    filename = os.path.join(index_dir, '{}.npy'.format(name))
+    with open(filename + '.tmp', 'wb') as file:
+        np.save(file, table)
+    os.replace(filename + '.tmp', filename)
+
+# Bring the season index of some processed games up to date
+# Games that were saved since the index was built are read again; the rows of every other game
+#     are copied from the old index and renumbered, so only new and changed games are loaded
+# Only games saved as tables are included; older pickled games are skipped
+# Returns the index, and the codes of the games that were read again
+def update_season_index(processed_dir, index_dir=None):
+    if index_dir is None:
+        index_dir = os.path.join(processed_dir, INDEX_DIRNAME)
+    games = game_module.load_processed_data(processed_dir, cache_size=0)
+    times = game_times(games)
+    index_info = read_index_info(index_dir)
+    if index_info is not None:
+        old_index = SeasonIndex(index_dir)
+        old_times = index_info['sources']
+        players = old_index.players()
+    else:
+        old_index = None
+        old_times = {}
+        players = {}
+
+    parts = {name: [] for name in SEASON_TABLES}
+    offsets = {name: 0 for name in SEASON_TABLES}
+    changed = []
+    for game_code in sorted(times):
+        if old_times.get(game_code) == times[game_code]:
+            rows = old_index.game_rows(int(game_code), offsets['possessions'], offsets['holds'],
+                                       offsets['shots'])
+        else:
+            game = games[game_code]
+            rows = game_season_rows(game, offsets['possessions'], offsets['holds'],
+                                    offsets['shots'])
+            players.update(game.players)
+            changed.append(game_code)
+        for name, table in zip(['possessions', 'holds', 'shots'], rows):
+            parts[name].append(table)
+            offsets[name] += len(table)
+    if old_index is not None and len(changed) == 0 and set(times) == set(old_times):
+        return old_index, changed
+
+    # Write every table and its indexes, then the index file last
+    os.makedirs(index_dir, exist_ok=True)
+    for name, structure in SEASON_TABLES.items():
+        table = np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=structure)
+        _save_table(index_dir, name, table)
+        for column in INDEXED_COLUMNS[name]:
+            _save_table(index_dir, '{} by {}'.format(name, column),
+                        np.argsort(table[column], kind='stable'))
+    with open(os.path.join(index_dir, PLAYERS_FILENAME + '.tmp'), 'wt') as file:
+        json.dump({str(player_id): player for player_id, player in players.items()}, file)
+    os.replace(os.path.join(index_dir, PLAYERS_FILENAME + '.tmp'),
+               os.path.join(index_dir, PLAYERS_FILENAME))
+    index_info = {'format': game_module.GAME_FORMAT_VERSION,
+                  'sources': times,
+                  'counts': offsets}
+    with open(os.path.join(index_dir, INDEX_FILENAME + '.tmp'), 'wt') as file:
+        json.dump(index_info, file, indent=1, sort_keys=True)
+    os.replace(os.path.join(index_dir, INDEX_FILENAME + '.tmp'),
+               os.path.join(index_dir, INDEX_FILENAME))
+    return SeasonIndex(index_dir), changed
+
+# Build the season index of some processed games from scratch
+def build_season_index(processed_dir, index_dir=None):
+    if index_dir is None:
+        index_dir = os.path.join(processed_dir, INDEX_DIRNAME)
+    if os.path.exists(os.path.join(index_dir, INDEX_FILENAME)):
+        os.remove(os.path.join(index_dir, INDEX_FILENAME))
+    index, _ = update_season_index(processed_dir, index_dir)
+    return index
+
+# Check whether a season index covers exactly the processed games, as they are now
+def is_season_index_up_to_date(processed_dir, index_dir=None):
+    if index_dir is None:
+        index_dir = os.path.join(processed_dir, INDEX_DIRNAME)
+    index_info = read_index_info(index_dir)
+    if index_info is None:
+        return False
+    games = game_module.load_processed_data(processed_dir, cache_size=0)
+    return game_times(games) == index_info['sources']
+
+# Open the season index of some processed games, updating it first if it is missing or stale
+def load_season_index(processed_dir, index_dir=None):
+    index, _ = update_season_index(processed_dir, index_dir)
+    return index
+
+# Use this class to query a season index
+# Tables and indexes are memory mapped the first time they're used
+# Filters are a dict from column to a value, a list of values, or a (low, high) range where
+#     low is inclusive, high is exclusive and either can be None
+# Filters on indexed columns are answered by searching their sorted index, and the rest are
+#     only checked on the rows that are left
+class SeasonIndex:
+    def __init__(self, index_dir, mmap_mode='r'):
+        self.index_dir = index_dir
+        self.mmap_mode = mmap_mode
+        self._tables = {}
+        self._sorted = {}
+
+    def __getitem__(self, name):
+        if name not in self._tables:
+            filename = os.path.join(self.index_dir, '{}.npy'.format(name))
+            self._tables[name] = np.load(filename, mmap_mode=self.mmap_mode)
+        return self._tables[name]
+
+    # Get a column's index: the order of the rows by the column, and the column in that order
+    def sorted_column(self, table_name, column):
+        key = (table_name, column)
+        if key not in self._sorted:
+            order = self['{} by {}'.format(table_name, column)]
+            self._sorted[key] = (order, np.asarray(self[table_name][column])[order])
+        return self._sorted[key]
+
+    # Find the rows matching one filter on an indexed column, in order
+    def _indexed_rows(self, table_name, column, condition):
+        order, values = self.sorted_column(table_name, column)
+        if isinstance(condition, tuple):
+            low, high = condition
+            first = 0 if low is None else np.searchsorted(values, low, side='left')
+            last = len(values) if high is None else np.searchsorted(values, high, side='left')
+            return np.sort(order[first:last])
+        if isinstance(condition, (list, set, np.ndarray)):
+            return np.sort(np.concatenate([self._indexed_rows(table_name, column, value)
+                                           for value in condition] + [np.zeros(0, dtype='int')]))
+        first, last = np.searchsorted(values, condition, side='left'), \
+                      np.searchsorted(values, condition, side='right')
+        return np.sort(order[first:last])
+
+    # Check a filter against some values of a column
+    @staticmethod
+    def _matches(values, condition):
+        if isinstance(condition, tuple):
+            low, high = condition
+            result = np.ones(len(values), dtype='bool')
+            if low is not None:
+                result &= values >= low
+            if high is not None:
+                result &= values < high
+            return result
+        if isinstance(condition, (list, set, np.ndarray)):
+            return np.isin(values, list(condition))
+        return values == condition
+
+    # Find the rows of a table that match every filter, in order
+    def select(self, table_name, filters=None):
+        filters = dict(filters or {})
+        table = self[table_name]
+        rows = None
+        for column in INDEXED_COLUMNS[table_name]:
+            if column in filters:
+                column_rows = self._indexed_rows(table_name, column, filters.pop(column))
+                rows = column_rows if rows is None else np.intersect1d(rows, column_rows,
+                                                                       assume_unique=True)
+        if rows is None:
+            rows = np.arange(len(table))
+        for column, condition in filters.items():
+            rows = rows[self._matches(np.asarray(table[column][rows]), condition)]
+        return rows
+
+    # Get the rows of one game, renumbered as if the game's rows started at the given offsets
+    def game_rows(self, game_code, possessions_offset, holds_offset, shots_offset):
+        possessions = self.rows('possessions', {'game': game_code})
+        holds = self.rows('holds', {'game': game_code})
+        shots = self.rows('shots', {'game': game_code})
+        if len(possessions) > 0:
+            # A game's first possession starts its holds and shots
+            first_possession = self.select('possessions', {'game': game_code})[0]
+            holds_shift = holds_offset - possessions['holds start'][0]
+            shots_shift = shots_offset - possessions['shots start'][0]
+            possessions_shift = possessions_offset - first_possession
+            possessions['holds start'] += holds_shift
+            possessions['holds stop'] += holds_shift
+            possessions['shots start'] += shots_shift
+            possessions['shots stop'] += shots_shift
+            holds['possession'] += possessions_shift
+            shots['possession'] = np.where(shots['possession'] >= 0,
+                                           shots['possession'] + possessions_shift, -1)
+        return possessions, holds, shots
+
+    # Get the players file row of every player in the season, by id
+    def players(self):
+        try:
+            with open(os.path.join(self.index_dir, PLAYERS_FILENAME), 'rt') as file:
+                return {int(player_id): player for player_id, player in json.load(file).items()}
+        except FileNotFoundError:
+            return {}
+
+    # Find the rows of a table that match every filter, as a mask over the table
+    def mask(self, table_name, filters=None):
+        result = np.zeros(len(self[table_name]), dtype='bool')
+        result[self.select(table_name, filters)] = True
+        return result
+
+    # Get the rows of a table that match every filter
+    def rows(self, table_name, filters=None):
+        return self[table_name][self.select(table_name, filters)]
+
+    # Get the holds, or shots, of some rows of the possessions table
+    def possession_rows(self, table_name, possessions):
+        possessions_table = self['possessions'][possessions]
+        starts = possessions_table['{} start'.format(table_name)]
+        stops = possessions_table['{} stop'.format(table_name)]
+        lengths = stops - starts
+        firsts = np.cumsum(lengths) - lengths
+        return np.repeat(starts - firsts, lengths) + np.arange(lengths.sum())
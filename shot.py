@@ -82,6 +82,19 @@ def classify_shot(shot_name):
     
     return result
 
+# Classify many shot descriptions at once
+# There are only a few dozen different descriptions, so each one is only classified the first time
+#     it is seen, and any unknown words are only reported then
+_classifications = {}
+def classify_shots(descriptions):
+    unique_descriptions, inverse = np.unique(np.asarray(descriptions, dtype='str'), return_inverse=True)
+    classifications = np.zeros(len(unique_descriptions), dtype='int32')
+    for i, description in enumerate(unique_descriptions.tolist()):
+        if description not in _classifications:
+            _classifications[description] = classify_shot(description)
+        classifications[i] = _classifications[description]
+    return classifications[inverse.reshape(-1)]
+
 # ESQ metrix from http://www.sloansportsconference.com/wp-content/uploads/2014/02/2014-SSAC-Quantifying-Shot-Quality-in-the-NBA.pdf
 ESQ_MAP = np.matrix(
    [[51.0, 41.7, 43.5, 46.9, 51.4, 54.6, 56.6, 58.8, 60.1, 60.8],
@@ -131,25 +144,105 @@ ESQ_MAP_CATCH = np.matrix(
     [53.8, 57.6, 68.5, 78.2, 85.2, 87.9, 85.5, 95.4, 92.6, 100]]
 )
 
+# The catch and shoot and off the dribble maps stacked, indexed by [off the dribble, shot distance,
+#     defender distance]
+ESQ_MAPS = np.stack([np.asarray(ESQ_MAP_CATCH), np.asarray(ESQ_MAP_DRIBBLE)])
+
+# Compute the quality of many shots at once, as Shot.calculate_shot_quality does for one
+# Shots with no defender or shot distance get NaN
+def calculate_shot_qualities(num_dribbles, defender_dist, shot_dist):
+    num_dribbles = np.asarray(num_dribbles)
+    defender_dist = np.asarray(defender_dist, dtype='float')
+    shot_dist = np.asarray(shot_dist, dtype='float')
+    known = np.isfinite(defender_dist) & np.isfinite(shot_dist)
+    defender_dist_index = np.clip(np.trunc(np.where(known, defender_dist, 0)), 0, 9).astype('int')
+    shot_dist_index = np.clip(12 - np.trunc(np.where(known, shot_dist, 0)/2.), 0, 12).astype('int')
+    qualities = ESQ_MAPS[(num_dribbles > 0).astype('int'), shot_dist_index, defender_dist_index]
+    return np.where(known, qualities, np.nan)
+
+# Use this class to store a shot
+# events is the quarter's events, shared by its shots, and event_index is this shot's event in it
+# The shooter is stored as an id into players, the dict of players shared by the whole game
 class Shot:
-    def __init__(self, event, position, description, shooter):
-        self.event = event
+    __slots__ = ('events', 'event_index', 'position', 'classification', 'shooter_id', 'players',
+                 'result', 'points', 'quality', 'dribbles', 'defender_dist', 'shot_dist', '_event')
+
+    def __init__(self, events, event_index, position, classification, shooter_id, players):
+        self.events = events
+        self.event_index = event_index
         self.position = position
-        self.classification = classify_shot(description)
-        self.shooter = shooter
+        self.classification = classification
+        self.shooter_id = shooter_id
+        self.players = players
+        self.result = None
+        self.points = None
+        self.quality = None
+        self.dribbles = None
+        self.defender_dist = None
+        self.shot_dist = None
+        self._event = None
+
+    # The event of the shot
+    @property
+    def event(self):
+        if self._event is not None or self.events is None:
+            return self._event
+        return self.events[self.event_index]
+
+    # The players file row of the shooter
+    @property
+    def shooter(self):
+        if self.players is None:
+            return None
+        return self.players.get(self.shooter_id)
+
+    # Shots pickled before __slots__ stored their event and shooter row
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        if isinstance(state, dict) and 'shooter' in state:
+            state = dict(state)
+            state['_event'] = state.pop('event')
+            state.setdefault('shooter_id', None)
+            state['players'] = {state['shooter_id']: state.pop('shooter')}
+        possession.set_slots_state(self, state)
     
     # Compute shot quality based on the dribbles, defender distance and shot distance
+    # The inputs are kept, so the shot can be scored again by other models
     def calculate_shot_quality(self, num_dribbles, defender_dist, shot_dist):
+        self.dribbles = num_dribbles
+        self.defender_dist = defender_dist
+        self.shot_dist = shot_dist
         defender_dist_index = max(min(9,int(defender_dist)),0)
     
         shot_dist_index = max(min(12,12-int(shot_dist/2.)),0)
 
-        esq_map = ESQ_MAP
-        if num_dribbles > 0:
-            esq_map = ESQ_MAP_DRIBBLE
-        else:
-            esq_map = ESQ_MAP_CATCH
-
-        self.quality = esq_map[shot_dist_index, defender_dist_index]
+        self.quality = ESQ_MAPS[1 if num_dribbles > 0 else 0, shot_dist_index, defender_dist_index]
         
-        return self.quality
\ No newline at end of file
+        return self.quality
+# The registered shot quality models, by name, as (version, function)
+# A model function takes a table of shots with the columns of game.SHOTS_STRUCTURE, and returns
+#     the quality of each shot
+# Change the version whenever a model's results change, so its saved results are recomputed
+SHOT_QUALITY_MODELS = {}
+DEFAULT_SHOT_QUALITY_MODEL = 'esq 2014'
+
+# Use this decorator to add a shot quality model
+def register_shot_quality_model(name, version=1):
+    def register(function):
+        SHOT_QUALITY_MODELS[name] = (version, function)
+        return function
+    return register
+
+# Find a registered shot quality model, returning its version and function
+def get_shot_quality_model(name):
+    try:
+        return SHOT_QUALITY_MODELS[name]
+    except KeyError:
+        raise ValueError('Unknown shot quality model {}'.format(name))
+
+# The expected shot quality maps from the 2014 Sloan paper, as used at processing time
+@register_shot_quality_model('esq 2014', version=1)
+def esq_2014(shots):
+    return calculate_shot_qualities(shots['dribbles'], shots['defender distance'],
+                                    shots['shot distance'])
@@ -0,0 +1,202 @@
+import csv
+import os
+import random
+from xml.sax.saxutils import quoteattr
+from possession import PlayTypes
+
+# The length of a quarter, in seconds, and of the shot clock
+QUARTER_LENGTH = 720.0
+SHOT_CLOCK_LENGTH = 24.0
+
+# The shot descriptions used in the play by play, as they appear in real games
+SHOT_DESCRIPTIONS = ['Jump Shot', 'Driving Layup', 'Dunk', 'Step Back Jump Shot',
+                     'Turnaround Fade Away Jump Shot', 'Tip Shot', 'Running Bank Shot',
+                     'Alley Oop Dunk', 'Floating Jump Shot', 'Hook Shot', 'Reverse Layup']
+
+# Format a value as an XML attribute, with its quotes
+def _attribute(value):
+    return quoteattr(str(value))
+
+# Format a time in seconds as the minutes:seconds the box score uses
+def _minutes_seconds(time):
+    return '{}:{:05.2f}'.format(int(time // 60), time % 60)
+
+# Pick two teams from the players file, and give their first ten players global ids
+# A player's global id comes from their row of the players file, so it is the same in every game,
+#     like a real player's
+# Returns the two team names, and a list of (global id, name) for each team
+def make_rosters(rnd, players_filename='players.csv', first_id=1000):
+    with open(players_filename, 'rt') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    teams = rnd.sample(sorted(set(row['team'] for row in rows)), 2)
+    rosters = []
+    for team in teams:
+        roster = [(first_id + i, row['name']) for i, row in enumerate(rows) if row['team'] == team]
+        rosters.append(roster[:10])
+    return teams, rosters
+
+# Play a quarter of possessions, alternating between the teams
+# Each possession is a chain of passes and dribbles that ends in a shot, a turnover, a foul or a
+#     shot clock violation; density scales how many passes and dribbles there are
+# length is the fraction of the quarter that is played
+# Returns the quarter's moments, its shots as (game clock, shooter, made), and its possessions as
+#     (team number, time start, time end)
+def play_quarter(rnd, rosters, length=1.0, density=1.0):
+    moments = [(QUARTER_LENGTH, PlayTypes.START_PERIOD, 0, '')]
+    shots = []
+    possessions = []
+    clock = QUARTER_LENGTH - 0.5
+    team = 0
+    max_actions = max(1, int(round(8*density)))
+    max_dribbles = max(1, int(round(4*density)))
+    while clock > QUARTER_LENGTH - (QUARTER_LENGTH - 20)*length:
+        roster = rosters[team]
+        start = clock + 0.2
+        shot_clock = SHOT_CLOCK_LENGTH
+        holder = rnd.choice(roster)[0]
+        def add_moment(event_type, player_id):
+            moments.append((round(clock, 2), event_type, player_id, round(shot_clock, 2)))
+        add_moment(PlayTypes.RECEIVE_PASS, holder)
+        for _ in range(rnd.randint(1, max_actions)):
+            elapsed = rnd.uniform(0.3, 2.5)/density
+            clock -= elapsed
+            shot_clock -= elapsed
+            action = rnd.random()
+            if action < 0.3:
+                for _ in range(rnd.randint(1, max_dribbles)):
+                    add_moment(PlayTypes.DRIBBLE, holder)
+                    clock -= 0.4
+                    shot_clock -= 0.4
+            elif action < 0.8:
+                add_moment(PlayTypes.THROW_PASS, holder)
+                clock -= 0.5
+                shot_clock -= 0.5
+                holder = rnd.choice(roster)[0]
+                add_moment(PlayTypes.RECEIVE_PASS, holder)
+            elif action < 0.85:
+                add_moment(PlayTypes.FOUL, rnd.choice(rosters[1 - team])[0])
+                break
+            elif action < 0.9:
+                add_moment(PlayTypes.TURNOVER, holder)
+                break
+            if shot_clock < 2:
+                add_moment(PlayTypes.SHOT_CLOCK_VIOLATION, holder)
+                break
+        else:
+            # The possession wasn't cut short, so it ends in a shot
+            elapsed = rnd.uniform(0.3, 2.0)
+            clock -= elapsed
+            shot_clock -= elapsed
+            made = rnd.random() < 0.45
+            add_moment(PlayTypes.FIELD_GOAL_MADE if made else PlayTypes.FIELD_GOAL_MISSED, holder)
+            shots.append((clock, holder, made))
+            clock -= 0.5
+            shot_clock -= 0.5
+            if not made:
+                rebound = PlayTypes.OFFENSIVE_REBOUND if rnd.random() < 0.25 else \
+                          PlayTypes.DEFENSIVE_REBOUND
+                add_moment(rebound, rnd.choice(roster)[0])
+        possessions.append((team, start, clock - 0.1))
+        clock -= 0.3
+        team = 1 - team
+    moments.append((round(clock, 2), PlayTypes.END_PERIOD, 0, ''))
+    return moments, shots, possessions
+
+# Write the four secondspectrum files of a made up game
+# The players are real rows of the players file, so they are matched like real players
+# The same seed always writes the same game
+def write_synthetic_game(dirname, game_code, seed, length=1.0, density=1.0,
+                         players_filename='players.csv'):
+    rnd = random.Random(seed)
+    teams, rosters = make_rosters(rnd, players_filename)
+    quarters = {quarter: play_quarter(rnd, rosters, length, density) for quarter in range(1, 5)}
+
+    # The players on court, five of each team at a time
+    with open(os.path.join(dirname, 'NBA_FINAL_ONCOURT${}.XML'.format(game_code)), 'wt') as file:
+        file.write('<sports-statistics><sports-oncourt><nba-oncourt><nba-oncourt-players>')
+        for tag, team, team_id in [('visiting-team', teams[0], 1), ('home-team', teams[1], 2)]:
+            city, name = team.rsplit(' ', 1)
+            file.write('<{0}><team-city city={1}/><team-name name={2}/>'
+                       '<team-code global-id={3}/></{0}>'.format(
+                           tag, _attribute(city), _attribute(name), _attribute(team_id)))
+        for unit in range(2):
+            file.write('<oncourt>')
+            for tag, roster in [('visiting-team-players', rosters[0]),
+                                ('home-team-players', rosters[1])]:
+                file.write('<{}>'.format(tag))
+                for player_id, name in roster[unit*5:(unit + 1)*5]:
+                    file.write('<player display-name={} global-id={}/>'.format(
+                        _attribute(name), _attribute(player_id)))
+                file.write('</{}>'.format(tag))
+            file.write('</oncourt>')
+        file.write('</nba-oncourt-players></nba-oncourt></sports-oncourt></sports-statistics>')
+
+    # The optical events of every quarter
+    with open(os.path.join(dirname, 'NBA_FINAL_SEQUENCE_PBP_OPTICAL${}.XML'.format(game_code)),
+              'wt') as file:
+        file.write('<sports-statistics><sports-boxscores><nba-boxscores><nba-boxscore>')
+        for quarter, (moments, _, _) in quarters.items():
+            file.write('<sequence-pbp period="{}">'.format(quarter))
+            for clock, event_type, player_id, shot_clock in moments:
+                file.write('<moment game-clock="{}" event-id="{}" global-player-id="{}" '
+                           'shot-clock="{}"/>'.format(clock, int(event_type), player_id, shot_clock))
+            file.write('</sequence-pbp>')
+        file.write('</nba-boxscore></nba-boxscores></sports-boxscores></sports-statistics>')
+
+    # The box score, with every player's shot log and the possessions of every quarter
+    with open(os.path.join(dirname, 'NBA_FINALBOX_OPTICAL${}.XML'.format(game_code)),
+              'wt') as file:
+        file.write('<sports-statistics><sports-boxscores><nba-boxscores><nba-boxscore>')
+        for roster in rosters:
+            file.write('<players>')
+            for player_id, _ in roster:
+                file.write('<player global-id="{}">'.format(player_id))
+                player_shots = [(clock, made) for _, shots, _ in quarters.values()
+                                for clock, shooter_id, made in shots if shooter_id == player_id]
+                if player_shots or rnd.random() < 0.5:
+                    file.write('<shot-log>')
+                    for clock, made in player_shots:
+                        file.write('<shot game-clock="{}" dribbles="{}" x-coordinate="{}" '
+                                   'y-coordinate="{}" shot-distance="{}" result="{}" '
+                                   'points-type="{}"><closest-defender defender-distance="{:.1f}"/>'
+                                   '</shot>'.format(
+                                       _minutes_seconds(clock), rnd.randint(0, 6),
+                                       round(rnd.uniform(-25, 25), 1), round(rnd.uniform(0, 30), 1),
+                                       round(rnd.uniform(0, 28), 1), 'made' if made else 'missed',
+                                       rnd.choice([2, 3]), rnd.uniform(0, 12)))
+                    file.write('</shot-log>')
+                file.write('</player>')
+            file.write('</players>')
+        file.write('<possessions>')
+        for quarter, (_, _, possessions) in quarters.items():
+            file.write('<quarter number="{}">'.format(quarter))
+            for team, time_start, time_end in possessions:
+                file.write('<possession team-global-id="{}" time-start="{}" time-end="{}"/>'.format(
+                    team + 1, _minutes_seconds(time_start), _minutes_seconds(time_end)))
+            file.write('</quarter>')
+        file.write('</possessions></nba-boxscore></nba-boxscores></sports-boxscores>'
+                   '</sports-statistics>')
+
+    # The play by play, which describes every shot
+    with open(os.path.join(dirname, 'NBA_FINALPBP_EXP${}.XML'.format(game_code)), 'wt') as file:
+        file.write('<sports-statistics><sports-scores><nba-scores><nba-playbyplay>')
+        for quarter, (_, shots, _) in quarters.items():
+            for clock, shooter_id, made in shots:
+                event_type = PlayTypes.FIELD_GOAL_MADE if made else PlayTypes.FIELD_GOAL_MISSED
+                file.write('<play quarter="{}" event-id="{}" time-minutes="{}" time-seconds="{:.2f}" '
+                           'detail-description={} global-player-id-1="{}"/>'.format(
+                               quarter, int(event_type), int(clock // 60), clock % 60,
+                               _attribute(rnd.choice(SHOT_DESCRIPTIONS)), shooter_id))
+        file.write('</nba-playbyplay></nba-scores></sports-scores></sports-statistics>')
+
+# Write the files of several made up games, with consecutive game codes
+# Returns the game codes
+def write_synthetic_games(dirname, number_of_games, seed=0, length=1.0, density=1.0,
+                          first_game_code=2016102500, players_filename='players.csv'):
+    os.makedirs(dirname, exist_ok=True)
+    game_codes = []
+    for i in range(number_of_games):
+        game_code = str(first_game_code + i)
+        write_synthetic_game(dirname, game_code, seed + i, length, density, players_filename)
+        game_codes.append(game_code)
+    return game_codes
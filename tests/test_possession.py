@@ -0,0 +1,56 @@
+import random
+import numpy as np
+import pytest
+from game import EVENTS_STRUCTURE
+from possession import Possession, PlayTypes, Thread, make_threads
+
+# An event type that isn't one of the PlayTypes
+UNKNOWN_EVENT_TYPE = 99
+
+# Make a quarter of random events, split into possessions of random lengths
+# Every event type turns up, but most events are the passes, dribbles and shots real
+#     possessions are made of, so threads are long enough to be interesting
+def make_possessions(seed, n_events=5000):
+    rnd = random.Random(seed)
+    all_types = [int(event_type) for event_type in PlayTypes] + [UNKNOWN_EVENT_TYPE]
+    common_types = [PlayTypes.DRIBBLE, PlayTypes.THROW_PASS, PlayTypes.RECEIVE_PASS,
+                    PlayTypes.FIELD_GOAL_MADE, PlayTypes.FIELD_GOAL_MISSED,
+                    PlayTypes.OFFENSIVE_REBOUND]
+    events = np.zeros(n_events, dtype=EVENTS_STRUCTURE)
+    events['event type'] = [rnd.choice(all_types) if rnd.random() < 0.4
+                            else int(rnd.choice(common_types)) for _ in range(n_events)]
+    events['shot clock'] = [round(rnd.uniform(0, 24), 2) for _ in range(n_events)]
+    events['game clock'] = np.linspace(720, 0, n_events)
+    events['event player id'] = [rnd.randint(1, 30) for _ in range(n_events)]
+
+    # Possessions of no events at all are made too
+    event_indices = []
+    start = 0
+    while start < n_events:
+        length = min(rnd.randint(0, 15), n_events - start)
+        event_indices.append(np.arange(start, start + length))
+        start += length
+    return events, event_indices
+
+# Describe a hold by everything make_thread records about it
+def describe_hold(hold):
+    return (hold.start_shot_clock, hold.player_id, hold.duration, hold.end_type)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_make_threads_matches_make_thread(seed):
+    events, event_indices = make_possessions(seed)
+    holds, offsets = make_threads(events, event_indices, 'game', 1)
+    assert len(offsets) == len(event_indices) + 1
+    assert len(holds) > 0
+
+    event_types = set()
+    for i, indices in enumerate(event_indices):
+        possession = Possession('game', 1, 1)
+        possession.make_thread(events[indices], {})
+        thread = Thread(holds, offsets[i], offsets[i + 1], {})
+        assert [describe_hold(hold) for hold in thread] == \
+               [describe_hold(hold) for hold in possession.thread]
+        event_types.update(events['event type'][indices].tolist())
+
+    # Every event type was in some possession
+    assert event_types == set(int(event_type) for event_type in PlayTypes) | {UNKNOWN_EVENT_TYPE}
@@ -236,6 +236,12 @@ def triangle_scatter_players(
         fig.canvas.draw_idle()
     fig.canvas.mpl_connect('motion_notify_event', hover_playername)
 
+# Count a player's passing or shooting entries, from a list of them or from aggregate.py's counts
+def record_count(player_record, key):
+    if key + ' count' in player_record:
+        return player_record[key + ' count']
+    return len(player_record[key])
+
 def plot_pass_shoot(
     players_records,
     players_to_highlight=[],
@@ -257,7 +263,7 @@ def plot_pass_shoot(
     data_to_plot = {'x':[],'y':[],'c':[],'s':[]}
     data_names = []
     for player_name, player_record in players_records:
-        if len(player_record['passing']) > 5 and len(player_record['shooting']) > 5:
+        if record_count(player_record, 'passing') > 5 and record_count(player_record, 'shooting') > 5:
             data_to_plot['x'].append(player_record['average passing'])
             data_to_plot['y'].append(player_record['average shooting'])
             data_to_plot['c'].append(c_func(player_record) if c_func is not None else None)